@@ -6,10 +6,21 @@
 #
 ##########################################################################
 
+import functools
+import hashlib
+import json
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
-from dateutil.relativedelta import *
 
+import config_file as cf
+from instrumentation import instrumented
+
+# version of the cleaned data schema, a new version invalidates old feather caches
+schema_version = 2
+
+@instrumented
 def load_csv_data(raw_data_path, **kwargs):
     """
     read in data. Data has to be in csv file format using the porvided input paths as Windows.Path
@@ -20,25 +31,316 @@ def load_csv_data(raw_data_path, **kwargs):
     """
 
     index = kwargs.get("index", "default")
-    raw_data = pd.read_csv(raw_data_path, sep=",", lineterminator="\n", encoding="utf-8",dtype={"year":str,"value":float})
+    raw_data = pd.read_csv(raw_data_path, sep=",", lineterminator="\n", encoding="utf-8",dtype={"year":"int16","value":float})
     if index != "default":
         raw_data = raw_data.set_index(index) 
     return raw_data
 
 
+@instrumented
+def load_partitions(raw_data_path, **kwargs):
+    """
+    read in the csv file in chunks and only keep the rows of the chosen gases and countries.
+    While reading the columns are made compact (categorical country and category, int16 year
+    plus date column, value optional as float32) and the rows are directly split into one dataframe per gas
+    like seperate_categories does.
+
+    :param raw_data_path: Windows.Path
+    :kwarg gases: list of short category labels, None keeps all gases
+    :kwarg countries: list, None keeps all countries
+    :kwarg chunksize: int rows per chunk
+    :kwarg value_dtype: str "float64" or "float32"
+    :returns working_dict: dict
+    """
+    gases = kwargs.get("gases", None)
+    countries = kwargs.get("countries", None)
+    chunksize = kwargs.get("chunksize", 100000)
+    value_dtype = kwargs.get("value_dtype", "float64")
+
+    short_labels = {}
+    partitions = {}
+    reader = pd.read_csv(raw_data_path, sep=",", lineterminator="\n", encoding="utf-8",
+                         dtype={"year": "int16", "value": float}, chunksize=chunksize)
+    for chunk in reader:
+        for label in chunk["category"].unique():
+            if label not in short_labels:
+                short_labels[label] = "_".join(label.split("_", 3)[:3])
+        category = chunk["category"].map(short_labels)
+
+        mask = pd.Series(True, index=chunk.index)
+        if gases is not None:
+            mask &= category.isin(gases)
+        if countries is not None:
+            mask &= chunk["country_or_area"].isin(countries)
+        if not mask.any():
+            continue
+
+        chunk = chunk[mask].assign(
+            country_or_area=chunk.loc[mask, "country_or_area"].astype("category"),
+            value=chunk.loc[mask, "value"].astype(value_dtype),
+            category=category[mask].astype("category"),
+        )
+        chunk["date"] = year_dates(chunk)
+        for gas, one_gas in chunk.groupby("category", observed=True, sort=False):
+            partitions.setdefault(gas, []).append(one_gas)
+
+    if gases is None:
+        gases = list(partitions.keys())
+    working_dict = {}
+    for gas in gases:
+        if gas in partitions:
+            working_dict[gas] = concat_partitions(partitions[gas])
+    return working_dict
+
+
+def concat_partitions(partitions):
+    """
+    concat dataframes and keep categorical columns categorical (the categories are united
+    first, pandas.concat would fall back to object columns otherwise)
+    :param partitions: list of pandas.DataFrame or dict of pandas.DataFrame
+    :returns emission_df: pandas.DataFrame
+    """
+    if isinstance(partitions, dict):
+        partitions = list(partitions.values())
+    first = partitions[0]
+    for column in first.columns:
+        if isinstance(first[column].dtype, pd.CategoricalDtype):
+            united = pd.api.types.union_categoricals([part[column] for part in partitions]).categories
+            partitions = [part.assign(**{column: part[column].cat.set_categories(united)})
+                          for part in partitions]
+    return pd.concat(partitions)
+
+
+@instrumented
+def load_cached_data(raw_data_path, cache_dir, **kwargs):
+    """
+    read in the cleaned emission data (output of prepare_emission_data) from a feather file in cache_dir. The cache is rebuilt from
+    the csv file whenever path, size, modification time or content hash of the csv file changed.
+    needs pyarrow to be installed.
+
+    :param raw_data_path: Windows.Path
+    :param cache_dir: Windows.Path
+    :kwarg rebuild: bool, force rebuilding the cache
+    :returns emission_df: pandas.DataFrame
+    """
+    rebuild = kwargs.get("rebuild", False)
+    try:
+        from pyarrow import feather
+    except ImportError as error:
+        raise ImportError("caching the emission data needs pyarrow (pip install pyarrow)") from error
+
+    raw_data_path = Path(raw_data_path).resolve()
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path_hash = hashlib.sha256(str(raw_data_path).encode("utf-8")).hexdigest()[:12]
+    cache_path = cache_dir.joinpath(raw_data_path.stem + "_" + path_hash + ".feather")
+    meta_path = cache_path.with_suffix(".json")
+
+    stat = raw_data_path.stat()
+    fingerprint = {"path": str(raw_data_path), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                   "version": schema_version}
+    cached = {}
+    if meta_path.exists() and cache_path.exists():
+        cached = json.loads(meta_path.read_text())
+
+    # size and modification time are checked first, the content hash only when they differ
+    valid = not rebuild and cached.get("path") == fingerprint["path"] and \
+        cached.get("size") == fingerprint["size"] and cached.get("version") == schema_version
+    if valid and cached.get("mtime") != fingerprint["mtime"]:
+        fingerprint["hash"] = file_hash(raw_data_path)
+        valid = cached.get("hash") == fingerprint["hash"]
+        if valid:
+            meta_path.write_text(json.dumps(fingerprint))
+
+    if valid:
+        return feather.read_feather(cache_path, memory_map=True)
+
+    emission_df = prepare_emission_data(load_csv_data(raw_data_path))
+    feather.write_feather(emission_df, cache_path)
+    if "hash" not in fingerprint:
+        fingerprint["hash"] = file_hash(raw_data_path)
+    meta_path.write_text(json.dumps(fingerprint))
+    return emission_df
+
+
+def file_hash(file_path):
+    """
+    sha256 hash of a file, read in blocks of 1 MB
+    :param file_path: Windows.Path
+    :returns: str
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+@instrumented
+def prepare_emission_data(raw_data):
+    """
+    clean the raw emission data into the compact schema used by all functions:
+    country_or_area and category (short labels) categorical, year int16 and date the year as
+    datetime (years_to_dates), the time axis of all following steps
+    :param raw_data: pandas.DataFrame
+    :returns emission_df: pandas.DataFrame
+    """
+    labels = ["_".join(label.split("_", 3)[:3]) for label in raw_data["category"].unique()]
+    emission_df = replace_categories(raw_data, labels)
+    emission_df = emission_df.assign(
+        country_or_area=emission_df["country_or_area"].astype("category"),
+        year=emission_df["year"].astype("int16"),
+    )
+    emission_df["date"] = year_dates(emission_df)
+    return emission_df
+
+
+def year_dates(em_data):
+    """
+    years of the data as datetime, from the date column if it exists
+    :param em_data: pandas.DataFrame
+    :returns: pandas.Series
+    """
+    if "date" in em_data.columns:
+        return em_data["date"]
+    return years_to_dates(em_data["year"])
+
+
+def years_to_dates(years):
+    """
+    first of january of every year, calculated on the integer years instead of parsing strings
+    :param years: pandas.Series of int (or str) years
+    :returns: pandas.Series datetime64[ns]
+    """
+    numbers = pd.to_numeric(years).to_numpy(dtype="int64")
+    dates = (numbers - 1970).astype("datetime64[Y]").astype("datetime64[ns]")
+    return pd.Series(dates, index=getattr(years, "index", None), name="date")
+
+
+def interpolation_freq(intervall):
+    """
+    pandas frequency of the interpolated series, None if the points are not evenly spaced in months
+    (SARIMAX can not forecast such a series, see forecasting.fit_forecast)
+    :param intervall: int or str
+    :returns: str or None
+    """
+    if isinstance(intervall, str):
+        return intervall
+    if intervall >= 1 and 12 % intervall == 0:
+        return str(12 // intervall) + "MS"
+    return None
+
+
+@functools.lru_cache(maxsize=256)
+def time_grid(first_year, last_year, intervall):
+    """
+    time grid from the first to the last year (both included) for dataframe_interpolation, series
+    with the same years share one grid. Month steps are calculated as datetime64[M] numbers.
+    :param first_year: int
+    :param last_year: int
+    :param intervall: int or str
+    :returns grid: pandas.DatetimeIndex (do not modify, it is cached)
+    """
+    if isinstance(intervall, str):
+        return pd.date_range(str(first_year), str(last_year), freq=intervall)
+    if intervall < 1:
+        raise ValueError(f"intervall has to be a positive integer, got: {intervall}")
+    if 12 % intervall == 0:
+        months = np.arange(first_year*12, last_year*12 + 1, 12 // intervall) - 1970*12
+        return pd.DatetimeIndex(months.astype("datetime64[M]").astype("datetime64[ns]"),
+                                freq=interpolation_freq(intervall))
+    # intervall does not split a year into whole months, spread the points evenly in every year
+    year_starts = (np.arange(first_year, last_year + 1) - 1970).astype("datetime64[Y]")\
+                      .astype("datetime64[ns]").astype("int64")
+    year_length = np.diff(year_starts)
+    steps = np.arange(intervall) / intervall
+    grid = year_starts[:-1, None] + (year_length[:, None] * steps).astype("int64")
+    return pd.DatetimeIndex(np.append(grid.ravel(), year_starts[-1]))
+
+
+class EmissionStore:
+    """
+    emission data sorted by country and category with an offset table, so the rows of one
+    country/category combination (or one country) are a slice of the sorted data instead of a
+    boolean mask over the whole table. The returned slices are views, do not modify them.
+
+    :param emission_df: pandas.DataFrame
+    """
+
+    def __init__(self, emission_df):
+        country_codes, countries = pd.factorize(emission_df["country_or_area"])
+        category_codes, categories = pd.factorize(emission_df["category"])
+        # lexsort is stable, the rows of one series keep their order
+        order = np.lexsort((category_codes, country_codes))
+        self.data = emission_df.take(order)
+
+        country_codes = country_codes[order]
+        category_codes = category_codes[order]
+        new_series = np.flatnonzero((np.diff(country_codes) != 0) | (np.diff(category_codes) != 0)) + 1
+        starts = np.concatenate([[0], new_series]).astype(int)
+        stops = np.concatenate([new_series, [len(order)]]).astype(int)
+
+        self.offsets = {}
+        self.country_offsets = {}
+        for start, stop in zip(starts, stops):
+            country = countries[country_codes[start]]
+            self.offsets[(country, categories[category_codes[start]])] = (start, stop)
+            first_start = self.country_offsets.get(country, (start, stop))[0]
+            self.country_offsets[country] = (first_start, stop)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def keys(self):
+        """
+        all (country, category) combinations
+        :returns: list of tuple
+        """
+        return list(self.offsets.keys())
+
+    def series(self, country, category):
+        """
+        rows of one country and one category, empty if the combination does not exist
+        :param country: str
+        :param category: str
+        :returns: pandas.DataFrame
+        """
+        start, stop = self.offsets.get((country, category), (0, 0))
+        return self.data.iloc[start:stop]
+
+    def country(self, country):
+        """
+        rows of all categories of one country
+        :param country: str
+        :returns: pandas.DataFrame
+        """
+        start, stop = self.country_offsets.get(country, (0, 0))
+        return self.data.iloc[start:stop]
+
+
 def replace_categories(one_country, labels):
     """
-    function replace all category labels with shorter names:
+    function replace all category labels with shorter names. The category column becomes
+    categorical and only its categories are renamed, labels used twice are merged.
     :param one_country: pandas.DataFrame
     :param labels: list
+    :returns one_country: pandas.DataFrame
     """
-    keys = one_country["category"].unique()
+    category = one_country["category"].astype("category")
+    keys = category.unique()
     replace_dict = {key: value for key,value in zip(keys,labels)}
 
-    one_country = one_country.replace(replace_dict)
+    new_labels = [replace_dict.get(old, old) for old in category.cat.categories]
+    unique_labels = list(dict.fromkeys(new_labels))
+    lookup = np.array([unique_labels.index(label) for label in new_labels], dtype=category.cat.codes.dtype)
+    codes = category.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, lookup[np.maximum(codes, 0)], -1)
+
+    one_country = one_country.assign(category=pd.Categorical.from_codes(new_codes, unique_labels))
     return one_country
 
 
+@instrumented
 def seperate_categories(emission_df,**kwargs):
     """
     emission_df contains emission data with different categories in one label they shall be 
@@ -50,126 +352,301 @@ def seperate_categories(emission_df,**kwargs):
     """
     working_labels = kwargs.get("choose_labels", ["carbon_dioxide_co2", "methane_ch4_emissions", \
                                                  'sulphur_hexafluoride_sf6'])
-    labels = ["_".join(label.split("_", 3)[:3]) for label in emission_df["category"].unique()]
-    
+    long_labels = emission_df["category"].unique()
+    labels = ["_".join(label.split("_", 3)[:3]) for label in long_labels]
+
+    # only the chosen categories are sliced, on a categorical column the comparison uses the codes
     emission_dict = {}
-    for label,long_label in zip(labels,emission_df["category"].unique()):
-        emission_dict[label] = emission_df.loc[emission_df["category"]==long_label]
+    for label,long_label in zip(labels,long_labels):
+        if label in working_labels:
+            emission_dict[label] = emission_df.loc[emission_df["category"]==long_label]
 
     working_dict = dict((key, emission_dict[key]) for key in working_labels)
 
     return working_dict
 
 
-def dataframe_interpolation(emission_df, intervall):
+@instrumented
+def dataframe_interpolation(emission_df, intervall, **kwargs):
     """
-    interpolate in between dataframe values. Add an interpolated value on each intervall row.
-    supported intervall are 2 and 3!
-    
+    interpolate in between dataframe values. The yearly values are reindexed onto a finer time
+    grid and the new points are filled by one (polynomial) interpolation per series.
+    intervall is either the number of values per year (12 months are split evenly if possible)
+    or a pandas frequency string like "4MS" or "QS". If emission_df holds more than one
+    country/category combination every series is interpolated on its own.
+
     :param emission_df: pandas.DataFrame
-    :param intervall: int
+    :param intervall: int or str
+    :kwarg method: str interpolation method of pandas.Series.interpolate (default "polynomial")
+    :kwarg order: int order of the polynomial/spline (default 2)
     :returns interpolated_df: pandas.Dataframe
     """
-    emission_df = emission_df.sort_values(by=["year"])
-    emission_df_loc = emission_df.reset_index()
-    index = range(0,len(emission_df)*intervall)
-    interpolated_df = pd.DataFrame(columns=emission_df.columns,index=index)
-    month = 12/intervall
+    method = kwargs.get("method", "polynomial")
+    order = kwargs.get("order", 2)
 
-    for ind, row in emission_df_loc.iterrows():
-        interpolated_df.iloc[ind*intervall] = [row["country_or_area"], row["year"], row["value"],\
-                                               row["category"] ]
-        
-    for ind, row in emission_df_loc.iterrows():
-        interpolated_df.iloc[ind*intervall+1] = [row["country_or_area"], row["year"]+ relativedelta(months=+month),\
-                                                 np.nan, row["category"] ]
-    if intervall == 3:
-        for ind, row in emission_df_loc.iterrows():
-            interpolated_df.iloc[ind*intervall+2] = [row["country_or_area"], row["year"]+\
-                                                      relativedelta(months=+month*2), np.nan, row["category"] ]
-    
+    interpolated_df = emission_df.groupby(["country_or_area", "category"], observed=True, sort=False,
+                                          group_keys=False)[emission_df.columns.tolist()]\
+                                 .apply(_interpolate_series, intervall, method, order)
+    interpolated_df = interpolated_df.reset_index(drop=True)
     interpolated_df["value"] = interpolated_df["value"].astype("float")
-    interpolated_df.loc[:,"value"]= interpolated_df.loc[:,"value"].interpolate(method="polynomial", order=2)
-    interpolated_df = interpolated_df.iloc[:-(intervall-1),:]
     return interpolated_df
 
 
+def _month_position(index):
+    """
+    position of time stamps in months, the first of each month is a whole number
+    :param index: pandas.DatetimeIndex
+    :returns: numpy.ndarray
+    """
+    month_start = index.to_period("M").to_timestamp()
+    month_length = (month_start + pd.offsets.MonthBegin(1)) - month_start
+    return np.asarray(index.year * 12 + index.month - 1 + (index - month_start) / month_length)
+
+
+def _interpolate_series(one_series, intervall, method, order):
+    """
+    interpolate the values of one country/category combination onto the grid of intervall
+    :param one_series: pandas.DataFrame
+    :param intervall: int or str
+    :param method: str
+    :param order: int
+    :returns interpolated: pandas.DataFrame
+    """
+    values = one_series.set_index(year_dates(one_series))["value"]
+    values = values[~values.index.duplicated()].sort_index().astype("float")
+    grid = time_grid(values.index[0].year, values.index[-1].year, intervall)
+
+    if values.count() <= order:
+        method = "linear"
+    # interpolate on the union, so the yearly values are used even if they are not on the grid.
+    # months are used as x values, so points of a monthly grid are evenly spaced
+    values = values.reindex(values.index.union(grid))
+    times = values.index
+    values.index = _month_position(times)
+    values = values.interpolate(method=method, order=order, limit_area="inside")
+    values.index = times
+    values = values.reindex(grid)
+
+    interpolated = pd.DataFrame({"year": grid, "value": values.to_numpy()})
+    first_row = np.zeros(len(grid), dtype=int)
+    columns = one_series.columns.drop("date", errors="ignore")
+    for column in columns.drop(["year", "value"]):
+        interpolated[column] = one_series[column].iloc[first_row].array
+    return interpolated[columns]
+
+
+@instrumented
 def calc_Results(em_data,categories, countries,  **kwargs):
     """
     calculate the desired measure for example max pultor for one gas for example CO2
-    :param em_data: pandas.DataFrame
+    :param em_data: pandas.DataFrame or EmissionStore
     :param countries: list
+    :kwarg rating_type: str ("max-year", "min-year", "max-total", "min-total", "most-improved" or "all"),
+                        most-improved is the maximum divided by the value of the earliest year
+    :kwarg engine: str "vectorized" (default, one groupby pass) or "loop" (old per country filtering)
+    :kwarg k: int length of the rankings
+    :kwarg years: tuple (first year, last year) only use these years, None for all
+    :returns results_dict: dict
+
+    Both engines give the same rankings. The total and improvement rankings are sorted before
+    rounding, ties are ordered like countries. Tied years of max-year/min-year keep the order of
+    the rows (the loop engine reads them from the EmissionStore sorted by country, the vectorized
+    engine in data order).
     """
     #get kwargs
     rating_type = kwargs.get("rating_type", "all")
+    engine = kwargs.get("engine", "vectorized")
+    k = kwargs.get("k", 3)
+    years = kwargs.get("years", None)
+
+    if years is not None:
+        if isinstance(em_data, EmissionStore):
+            em_data = em_data.data
+        first_year, last_year = years
+        year = em_data["year"] if em_data["year"].dtype.kind in "iu" else year_dates(em_data).dt.year
+        em_data = em_data[year.between(first_year if first_year is not None else -np.inf,
+                                       last_year if last_year is not None else np.inf)]
+
+    if engine == "loop":
+        return _calc_results_loop(em_data, categories, countries, rating_type, k)
+    elif engine == "vectorized":
+        if isinstance(em_data, EmissionStore):
+            em_data = em_data.data
+        return _calc_results_vectorized(em_data, categories, countries, rating_type, k)
+    else:
+        raise ValueError(f"unknown engine: {engine}")
+
+
+def _calc_results_vectorized(em_data, categories, countries, rating_type, k=3):
+    """
+    single pass version of calc_Results. The data of all interesting gases is grouped once
+    by category (and country) instead of filtering the whole frame for every gas and country.
+    :param em_data: pandas.DataFrame
+    :param categories: list
+    :param countries: list
+    :param rating_type: str
+    :param k: int
+    :returns results_dict: dict
+    """
+    results_dict = {}
+    rating_types = ["max-year", "min-year", "max-total", "min-total", "most-improved"]
+    wanted = rating_types if rating_type == "all" else [rating_type]
+
+    em_data = em_data[em_data["category"].isin(categories)]
+    em_data = em_data.assign(year=year_dates(em_data)).drop(columns="date", errors="ignore")
+    by_gas = em_data.groupby("category", observed=True, sort=False)["value"]
+
+    for rating, ascending in [("max-year", False), ("min-year", True)]:
+        if rating in wanted:
+            if ascending:
+                extreme = by_gas.nsmallest(k)
+            else:
+                extreme = by_gas.nlargest(k)
+            extreme_index = extreme.index.get_level_values(-1)
+            extreme_gas = extreme.index.get_level_values(0)
+            results_dict[rating] = {}
+            for gas in categories:
+                rows = em_data.loc[extreme_index[extreme_gas == gas]]
+                results_dict[rating][gas] = round(rows, 1)
+
+    if not set(wanted) & {"max-total", "min-total", "most-improved"}:
+        return results_dict
+
+    # sum, first and max value of every gas/country combination in one go
+    one_pass = em_data[em_data["country_or_area"].isin(countries)]
+    grouped = one_pass.groupby(["category", "country_or_area"], observed=True, sort=False)
+    aggregated = grouped["value"].agg(["sum", "max"])
+    # value of the earliest year (the csv is sorted newest year first), not of the first row
+    aggregated["first"] = one_pass.loc[grouped["year"].idxmin().to_numpy(), "value"].to_numpy()
+    # countries without any values count as a total of zero (same as summing an empty slice)
+    totals = aggregated["sum"].reindex(pd.MultiIndex.from_product([categories, countries]), fill_value=0)
+    totals = totals.rename(None)
+
+    for rating, prefix, ascending in [("max-total", "max_total_", False), ("min-total", "min_total_", True)]:
+        if rating in wanted:
+            results_dict[rating] = {}
+            for gas in categories:
+                gas_total = totals.loc[gas]
+                gas_total.index = [prefix + gas + "_" + country for country in gas_total.index]
+                # sorted before rounding and stable like the loop engine (nlargest is not stable for k >= n)
+                gas_total = gas_total.sort_values(ascending=ascending, kind="stable")
+                results_dict[rating][gas] = round(gas_total, 1)[:k]
+
+    if "most-improved" in wanted:
+        results_dict["most-improved"] = {}
+        improved_all = aggregated["max"] / aggregated["first"]
+        for gas in categories:
+            if gas in improved_all.index.get_level_values(0):
+                improved = improved_all.loc[gas]
+                # ties ordered like countries, as in the loop engine
+                improved = improved.reindex(pd.Index(countries).intersection(improved.index, sort=False))
+            else:
+                improved = pd.Series(dtype=float)
+            improved.index = ["most-improved_" + gas + "_" + country for country in improved.index]
+            improved = improved.sort_values(ascending=False, kind="stable")
+            results_dict["most-improved"][gas] = round(improved, 2)[:k]
+
+    return results_dict
+
+
+def _calc_results_loop(em_data, categories, countries, rating_type, k=3):
+    """
+    original version of calc_Results, looping over every gas and country. The series of one
+    country are looked up in an EmissionStore.
+    :param em_data: pandas.DataFrame or EmissionStore
+    :param categories: list
+    :param countries: list
+    :param rating_type: str
+    :param k: int
+    :returns results_dict: dict
+    """
     results_dict = {}
     result_temp = {}
 
-    years = pd.to_datetime(em_data["year"], format='%Y')
-    em_data.loc[:,"year"] = years
+    # a passed store is used as it is, only a plain dataframe is sorted into one
+    store = em_data if isinstance(em_data, EmissionStore) else EmissionStore(em_data)
     
     if rating_type == "max-year" or rating_type == "all":
         results_dict["max-year"] = {}   
         for gas in categories:
-            one_gas = em_data[em_data["category"]==gas]
-            maximum = one_gas.sort_values("value",ascending=False)[:3]
-            results_dict["max-year"][gas] = round(maximum,1)
+            one_gas = _gas_rows(store, gas)
+            maximum = one_gas.sort_values("value",ascending=False, kind="stable")[:k]
+            results_dict["max-year"][gas] = round(_with_dates(maximum),1)
 
     if rating_type == "min-year" or rating_type == "all":
         results_dict["min-year"] = {}   
         for gas in categories:
-            one_gas = em_data[em_data["category"]==gas]
-            minimum = one_gas.sort_values("value",ascending=True)[:3]
-            results_dict["min-year"][gas] = round(minimum,1)
+            one_gas = _gas_rows(store, gas)
+            minimum = one_gas.sort_values("value",ascending=True, kind="stable")[:k]
+            results_dict["min-year"][gas] = round(_with_dates(minimum),1)
 
 
     if rating_type == "max-total" or rating_type == "all":
         results_dict["max-total"] = {}
-        result_temp["max-total"] = {}   
         for gas in categories:
-            one_gas = em_data[em_data["category"]==gas]
+            result_temp["max-total"] = {}
             for country in countries:
-                working_data = one_gas[one_gas["country_or_area"]==country]
+                working_data = store.series(country, gas)
                 working_data = working_data.set_index("year")
                 result_temp["max-total"]["max_total_" +gas + "_" + country] = working_data["value"].sum()
-            max_tot = round(pd.Series(result_temp["max-total"]).sort_values(ascending=False),1)
-            results_dict["max-total"][gas] = max_tot[:3]
+            max_tot = round(pd.Series(result_temp["max-total"]).sort_values(ascending=False, kind="stable"),1)
+            results_dict["max-total"][gas] = max_tot[:k]
 
     if rating_type == "min-total" or rating_type == "all":
         results_dict["min-total"] = {}
-        result_temp["min-total"] ={}  
         for gas in categories:
-            one_gas = em_data[em_data["category"]==gas]
+            result_temp["min-total"] = {}
             for country in countries:
-                working_data = one_gas[one_gas["country_or_area"]==country]
+                working_data = store.series(country, gas)
                 working_data = working_data.set_index("year")
                 result_temp["min-total"]["min_total_" + gas + "_" + country] = working_data["value"].sum()
-            min_tot =round(pd.Series(result_temp["min-total"]).sort_values(ascending=True),1)
-            results_dict["min-total"][gas] = min_tot[:3]
+            min_tot =round(pd.Series(result_temp["min-total"]).sort_values(ascending=True, kind="stable"),1)
+            results_dict["min-total"][gas] = min_tot[:k]
 
     if rating_type == "most-improved" or rating_type == "all":
         results_dict["most-improved"] = {} 
-        result_temp["most-improved"] = {} 
         for gas in categories:
-            one_gas = em_data[em_data["category"]==gas]
+            result_temp["most-improved"] = {}
             for country in countries:
-                working_data = one_gas[one_gas["country_or_area"]==country]
+                working_data = store.series(country, gas)
                 working_data = working_data.set_index("year")
                 if len(working_data) != 0:
                     result_temp["most-improved"]["most-improved_" +gas + "_" + country] = \
-                          working_data["value"].max() / working_data["value"].iloc[0] 
-            improved = round(pd.Series(result_temp["most-improved"]).sort_values(ascending=False),2)
-            results_dict["most-improved"][gas] = improved[:3]
+                          working_data["value"].max() / working_data["value"].iloc[working_data.index.argmin()]
+            improved = round(pd.Series(result_temp["most-improved"]).sort_values(ascending=False, kind="stable"),2)
+            results_dict["most-improved"][gas] = improved[:k]
 
     return results_dict            
-            
-            
-            
+
+
+def _gas_rows(store, gas):
+    """
+    rows of one gas of all countries, concatenated from the slices of the store
+    :param store: EmissionStore
+    :param gas: str
+    :returns: pandas.DataFrame
+    """
+    slices = [store.data.iloc[start:stop] for (country, category), (start, stop) in store.offsets.items()
+              if category == gas]
+    if not slices:
+        return store.data.iloc[0:0]
+    return pd.concat(slices)
+
+
+def _with_dates(rows):
+    """
+    year column of result rows as datetime (like the vectorized engine)
+    :param rows: pandas.DataFrame
+    :returns: pandas.DataFrame
+    """
+    return rows.assign(year=year_dates(rows)).drop(columns="date", errors="ignore")
            
 
+@instrumented
 def flatten_result_and_csv(results_dict):
     """
-    export results to Excel for faster plotting and analysis due to time constraint
+    export results to Excel for faster plotting and analysis due to time constraint.
+    Old export with printed dataframes in the cells, see export_results for a table.
     :param results_dict: dict
     """
         
@@ -184,6 +661,118 @@ def flatten_result_and_csv(results_dict):
     improved.to_csv("improved" +".csv")
 
 
+# columns of the long result table
+result_columns = ["metric", "gas", "rank", "country", "year", "value"]
+# prefix of the row labels of the total and improvement rankings
+result_label_prefix = {"max-total": "max_total_", "min-total": "min_total_", "most-improved": "most-improved_"}
+
+def tidy_results(results_dict):
+    """
+    results of calc_Results as one long table with one row per ranked entry:
+    metric, gas, rank (starting at 1), country, year (only for max-year/min-year) and value
+    :param results_dict: dict
+    :returns result_df: pandas.DataFrame
+    """
+    parts = []
+    for metric, gas_results in results_dict.items():
+        gases = list(gas_results.keys())
+        for gas, ranking in gas_results.items():
+            if isinstance(ranking, pd.DataFrame):
+                countries = ranking["country_or_area"].astype(str).to_numpy()
+                years = ranking["year"].dt.year.to_numpy() if ranking["year"].dtype.kind == "M" \
+                    else ranking["year"].to_numpy()
+            else:
+                countries = [_label_country(label, result_label_prefix[metric], gases) for label in ranking.index]
+                years = None
+            parts.append(pd.DataFrame({
+                "metric": metric,
+                "gas": gas,
+                "rank": np.arange(1, len(ranking) + 1, dtype="int16"),
+                "country": countries,
+                "year": pd.array(years if years is not None else [pd.NA] * len(ranking), dtype="Int16"),
+                "value": ranking["value"].to_numpy(dtype="float64") if isinstance(ranking, pd.DataFrame)
+                         else ranking.to_numpy(dtype="float64"),
+            }))
+    if len(parts) == 0:
+        return pd.DataFrame(columns=result_columns)
+    return pd.concat(parts, ignore_index=True)[result_columns]
+
+
+def _label_country(label, prefix, gases):
+    """
+    country of a ranking label like "max_total_<gas>_<country>"
+    """
+    label = label[len(prefix):]
+    for gas in sorted(gases, key=len, reverse=True):
+        if label.startswith(gas + "_"):
+            return label[len(gas) + 1:]
+    return label
+
+
+@instrumented
+def export_results(results_dict, **kwargs):
+    """
+    write the results as long table (tidy_results) in one go to csv and/or parquet and optionally
+    append them with the run date to the table "results" of a sqlite or duckdb (suffix .duckdb) database
+    :param results_dict: dict
+    :kwarg results_name: str file name without suffix
+    :kwarg formats: list of "csv", "parquet" (needs pyarrow)
+    :kwarg database: Windows.Path or None
+    :kwarg rankings: pandas.DataFrame more rows with the same columns (e.g. ranking.rank_many)
+    :returns result_df: pandas.DataFrame
+    """
+    rankings = kwargs.get("rankings", None)
+    results_name = kwargs.get("results_name", cf.save_results_name)
+    formats = kwargs.get("formats", cf.result_formats)
+    database = kwargs.get("database", cf.result_database)
+
+    result_df = tidy_results(results_dict)
+    if rankings is not None:
+        result_df = pd.concat([result_df, rankings], ignore_index=True)
+    if "csv" in formats:
+        result_df.to_csv(results_name + ".csv", index=False)
+    if "parquet" in formats:
+        # needs pyarrow
+        result_df.to_parquet(results_name + ".parquet", index=False)
+    if database is not None:
+        append_results_database(result_df, database)
+    return result_df
+
+
+def append_results_database(result_df, database):
+    """
+    append the long result table to the table "results" (with the column run_date) and index it by
+    metric/gas and country. Files with the suffix .duckdb need duckdb, all others are sqlite databases.
+    :param result_df: pandas.DataFrame
+    :param database: Windows.Path
+    """
+    from datetime import datetime
+
+    result_df = result_df.assign(run_date=datetime.now().isoformat(timespec="seconds"))
+    Path(database).parent.mkdir(parents=True, exist_ok=True)
+    index_sql = ["CREATE INDEX IF NOT EXISTS results_metric_gas ON results (metric, gas, rank)",
+                 "CREATE INDEX IF NOT EXISTS results_country ON results (country)"]
+
+    if Path(database).suffix == ".duckdb":
+        import duckdb
+        with duckdb.connect(str(database)) as connection:
+            connection.register("new_results", result_df)
+            connection.execute("CREATE TABLE IF NOT EXISTS results AS SELECT * FROM new_results LIMIT 0")
+            connection.execute("INSERT INTO results SELECT * FROM new_results")
+            for sql in index_sql:
+                connection.execute(sql)
+    else:
+        import sqlite3
+        connection = sqlite3.connect(database)
+        try:
+            with connection:
+                result_df.astype({"year": "object"}).to_sql("results", connection, if_exists="append", index=False)
+                for sql in index_sql:
+                    connection.execute(sql)
+        finally:
+            connection.close()
+
+
 
 
 
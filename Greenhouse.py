@@ -1,5 +1,3 @@
-
-
 """
 ## module:: main file
 #     :platform:   Windows
@@ -12,201 +10,358 @@
 ##########################################################################
 
 .. Overview of the file:
-    1) comments
-    2) Input
-    3) general preprocessing
-    4) calculate Correlation
-    5) calculate prediction
-    6) preprocessing
-    7) applying methods
-    8) evaluation
+    1) Input                    -> Pipeline.load
+    2) general preprocessing    -> Pipeline.prepare
+    3) analysis                 -> Pipeline.analyze
+    4) correlation              -> Pipeline.correlate
+    5) interpolation            -> Pipeline.interpolate
+    6) prediction (SARIMAX)     -> Pipeline.forecast
+    7) plots                    -> Pipeline.report
+
+Every stage runs the stages it depends on, if they did not run yet. With memoize the results
+of the stages are stored and only stages after a changed setting run again. Statsmodels and bokeh are
+only imported by the stages, which need them. With --trace time, memory and rows of the stages and
+functions are written to trace_dir (see instrumentation). From the command line:
+
+    python Greenhouse.py --stages analyze forecast --headless
+    python Greenhouse.py --trace --profile analyze
 """
 #%%
+import argparse
+import hashlib
+import inspect
+import pickle
+from pathlib import Path
+
 #import self written files:
 import Data_preperation as dp
 import config_file as cf
-import plotting as pt
-
-#import data proccessing packages
-import pandas as pd
-from dateutil.relativedelta import *
-
-
-from statsmodels.tsa.statespace.sarimax import SARIMAX
-
-# Plotting
-import matplotlib.pyplot as plt
-plt.style.use('fivethirtyeight')
-plt.rcParams['lines.linewidth'] = 1.5
-plt.rcParams['font.size'] = 10
-
-######################################################################
-#comments old predictions
-#
-##from sklearn.ensemble import RandomForestRegressor
-#from lightgbm import LGBMRegressor
-#from sklearn.metrics import mean_squared_error
-#import skforecast
-#from skforecast.recursive import ForecasterRecursive
-#from skforecast.model_selection import TimeSeriesFold
-#from skforecast.model_selection import grid_search_forecaster
-#from skforecast.model_selection import backtesting_forecaster
-#from skforecast.preprocessing import RollingFeatures
-#from skforecast.utils import save_forecaster
-#from skforecast.utils import load_forecaster
-
-######################################################################
-#Input
-  
-
-Emission_df = dp.load_csv_data(cf.emission_data_path)
-
-#%%
-######################################################################
-#general preprocessing (not associated with any methode or any of the four preprocessing methods later on)
-original_categories = Emission_df["category"].unique()
-categories = ["_".join(label.split("_", 3)[:3]) for label in Emission_df["category"].unique()]
-countries = Emission_df["country_or_area"].unique()
-
-Emission_df = dp.replace_categories(Emission_df, categories)
-
-working_dict = dp.seperate_categories(Emission_df, choose_labels=cf.interesting_gases)
-
-######################################################################
-#section one_gas
-one_gas = Emission_df[Emission_df["category"]=="carbon_dioxide_co2"]
-years = pd.to_datetime(one_gas["year"], format='%Y')
-one_gas.loc[:,"year"] = years
-one_gas = one_gas.set_index("year")
-# choose data from European union 
-
-######################################################################
-
-######################################################################
-#section one_country
-one_country = Emission_df[Emission_df["country_or_area"]=="European Union"]
-years = pd.to_datetime(one_country["year"], format='%Y')
-one_country.loc[:,"year"] = years
-one_country = one_country.set_index("year")
-# choose data from European union 
-
-######################################################################
-# data analysis find biggest polluters an best practise examples
-# for better understanding of data plot all countries with all gases
-if cf.plot_all_countries == True:
-    i = 1
-    for country in countries:
-        one_c = Emission_df[Emission_df["country_or_area"]==country]
-        years = pd.to_datetime(one_c["year"], format='%Y')
-        one_c.loc[:,"year"] = years
-        one_c = one_c.set_index("year")
-
-        output_name = country + "_all_gases.html"
-        title_name = "all emssions of: " + country
-        print(f"Step: {i} of {len(countries)}")
-        i+=1
-        dp.plot_all_gases(one_c, categories, categories, output_name = output_name,title=title_name)
-
-if cf.make_analysis == True:
-    results = dp.calc_Results(Emission_df,cf.interesting_gases, countries)
-    dp.flatten_result_and_csv(results)
-
-
-
-######################################################################
-#starting prediction section
-######################################################################
-sf6 = working_dict["sulphur_hexafluoride_sf6"]
-sf6_EU = sf6[sf6["country_or_area"]=="European Union"] #  European Union
-#convert years to datetime
-years = pd.to_datetime(sf6_EU["year"], format='%Y')
-sf6_EU.loc[:,"year"] = years
-
-######################################################################
-#polynomial interpolation of data to get more values
-sf6_EU_interpolated = dp.dataframe_interpolation(sf6_EU, cf.interpolation_intervall)
-######################################################################
-sf6_EU_interpolated = sf6_EU_interpolated[["year","value"]]
-sf6_EU_interpolated = sf6_EU_interpolated.set_index("year")
-#creat correct frequency for time series analyis yearly
-sf6_EU_interpolated = sf6_EU_interpolated.asfreq('4MS') #
-# data is already sorted correctly but to be sure for other data sets
-sf6_EU_interpolated = sf6_EU_interpolated.sort_index()
-sf6_EU_interpolated = sf6_EU_interpolated.rename(columns={"value":"y"})
-
-######################################################################
-# define old train and test sets randforest regressor
-#steps = 7
-#prediction_steps = 7
-#train = sf6_EU_interpolated[:-steps]#no random splitting because timeseries [20:-steps]
-#test  = sf6_EU_interpolated[-steps:]
-
-######################################################################
-#plot train test split
-#pt.plot_train_test(train,test)
-
+import instrumentation
+
+STAGES = ["load", "prepare", "analyze", "correlate", "interpolate", "forecast", "report"]
+# stages each stage depends on
+STAGE_DEPENDENCIES = {
+    "load": [],
+    "prepare": ["load"],
+    "analyze": ["prepare"],
+    "correlate": ["prepare"],
+    "interpolate": ["prepare"],
+    "forecast": ["interpolate"],
+    "report": ["forecast"],
+}
+# settings (pipeline attributes or config_file values), which change the result of a stage or the
+# files it exports (a memoized stage does not export again)
+STAGE_PARAMETERS = {
+    "load": ["data_path", "use_data_cache", "chunked_loading", "gases", "load_countries", "value_dtype"],
+    "prepare": ["gases"],
+    "analyze": ["gases", "ranking_k", "ranking_years", "ranking_metrics", "save_results_name", "result_formats",
+                "result_database"],
+    "correlate": ["gases", "similarity_metrics", "similarity_normalize"],
+    "interpolate": ["batch", "interpolation_intervall", "forecast_country", "forecast_gas"],
+    "forecast": ["batch", "forecast_engine", "forecast_country", "forecast_gas", "train_percent",
+                 "sarimax_order", "seasonal_order", "forecast_steps", "auto_order", "order_search",
+                 "order_criterion", "max_order", "max_seasonal_order", "forecast_alpha", "simulate_paths",
+                 "path_quantiles", "save_forecast_name", "forecast_formats"],
+    "report": [],
+}
+# attributes stored for memoized stages, the report only writes files and always runs
+STAGE_OUTPUTS = {
+    "load": ["emission_df", "working_dict"],
+    "prepare": ["emission_df", "categories", "countries", "working_dict", "store"],
+    "analyze": ["results", "rankings"],
+    "correlate": ["similarity"],
+    "interpolate": ["series_dict"],
+    "forecast": ["prediction", "forecast_table"],
+}
+
+# increase after changes of the called modules, which change the result of a stage or the stored
+# attributes. Changes of the stage methods themselves are found by the hash of their source
+STAGE_CACHE_VERSION = 1
 
 ######################################################################
-#first prediction - no good quality
-"""regressor = RandomForestRegressor(random_state=123, n_estimators=100)
-forecaster = ForecasterRecursive(regressor, lags = 2)
-
-#fit data
-forecaster.fit(y=train["value"])
-predictions = forecaster.predict(steps=prediction_steps)
-
-#calculate error
-error_mse = mean_squared_error(y_true = test["value"], y_pred = predictions)
-
-fig, ax = plt.subplots(figsize=(6, 2.5))
-train["value"].plot(ax=ax, label="train")
-test["value"].plot(ax=ax, label="test")
-predictions.plot(ax=ax, label="prediction-without backtracking")
-ax.legend();
-"""
-######################################################################
-#new approach using a SARIMAX model for predicting
-percent_80 = int(round(len(sf6_EU_interpolated)*0.85,0))   #int(round(len(sf6_EU_interpolated)*cf.test_percent,0)) # 80/20 split
-train = sf6_EU_interpolated[:percent_80]#no random splitting because timeseries [20:-steps]
-test = sf6_EU_interpolated[percent_80:]
-offset = 10000
-
-
-#%%
-#############################################################################
-#SARIMAX
-model = SARIMAX(
-    train['y'],  # Training data
-    order=(1, 1, 0),  # (p, d, q) order: adjust based on data behavior
-    seasonal_order=(0, 0, 0, 0),  # No seasonality
-    enforce_stationarity=False,
-    enforce_invertibility=False
-)
-
-sarimax_results = model.fit(disp=False)
-
-# Predict future values 30 steps = 120 months
-n_forecast_steps = 30
-future_years = pd.date_range(start=train.index[-1] + pd.DateOffset(months=4), periods=n_forecast_steps, freq='4MS')
-forecast_values = sarimax_results.get_forecast(steps=n_forecast_steps).predicted_mean
-
-# Backtesting on test data (i.e. kross falidating time series data)
-backtest_values = sarimax_results.get_prediction(start=test.index[0], end=test.index[-1]).predicted_mean
-
-# Combine data for visualization
-forecast_df = pd.DataFrame({'y': forecast_values}, index=future_years)
-backtest_df = pd.DataFrame({'y': backtest_values}, index=test.index)
-
-# Combine everything for plotting
-train['type'] = 'train'
-test['type'] = 'test'
-backtest_df['type'] = 'backtest'
-forecast_df['type'] = 'forecast'
-
-combined_df = pd.concat([train, test, backtest_df, forecast_df])
-
-pred_title_name = "prediction of SF6 emission within the EU for the next 10 years "
-
-pt.plot_prediction(train,test,backtest_df,forecast_df,title = pred_title_name)
 
-print("DONE JUHU!")
\ No newline at end of file
+class Pipeline:
+    """
+    all steps of the data challenge as separately callable stages. The results of each stage are
+    kept as attributes (emission_df, store, working_dict, results, rankings, similarity,
+    series_dict, prediction, forecast_table) and reused by the following stages.
+
+    :kwarg data_path: Windows.Path csv file of the emission data
+    :kwarg gases: list gases for the analysis and the forecasts
+    :kwarg batch: bool forecast all countries and gases instead of one series
+    :kwarg workers: int worker processes of the batch forecast
+    :kwarg report_workers: int worker processes of the report pages
+    :kwarg headless: bool only save the plots, do not open them
+    :kwarg memoize: bool store the stage results in stage_cache_dir and reuse them as long as
+                    the stage and the stages before it have the same settings and input file
+    """
+
+    def __init__(self, **kwargs):
+        self.data_path = kwargs.get("data_path", cf.emission_data_path)
+        self.gases = kwargs.get("gases", cf.interesting_gases)
+        self.batch = kwargs.get("batch", cf.batch_forecast)
+        self.workers = kwargs.get("workers", cf.forecast_workers)
+        self.report_workers = kwargs.get("report_workers", cf.report_workers)
+        self.headless = kwargs.get("headless", cf.headless_plots)
+        self.memoize = kwargs.get("memoize", cf.memoize_stages)
+        self.finished = set()
+
+        self.emission_df = None
+        self.categories = None
+        self.countries = None
+        self.working_dict = None
+        self.store = None
+        self.results = None
+        self.rankings = None
+        self.similarity = None
+        self.series_dict = None
+        self.prediction = None
+        self.forecast_table = None
+
+    def load(self):
+        """
+        read in the emission data (from the feather cache if enabled). With chunked_loading only
+        the interesting gases are read, already split into one dataframe per gas.
+        """
+        if cf.chunked_loading == True:
+            self.working_dict = dp.load_partitions(self.data_path, gases=self.gases, countries=cf.load_countries,
+                                                   chunksize=cf.load_chunksize, value_dtype=cf.value_dtype)
+            self.emission_df = dp.concat_partitions(self.working_dict)
+        elif cf.use_data_cache == True:
+            self.emission_df = dp.load_cached_data(self.data_path, cf.cache_dir)
+        else:
+            self.emission_df = dp.load_csv_data(self.data_path)
+        return self.emission_df
+
+    def prepare(self):
+        """
+        general preprocessing: compact schema with short category labels (see
+        Data_preperation.prepare_emission_data), one dataframe per interesting gas and an
+        EmissionStore for the lookup of single series
+        """
+        if self.emission_df is None:
+            self.run_stage("load")
+        if "date" not in self.emission_df.columns:
+            self.emission_df = dp.prepare_emission_data(self.emission_df)
+        self.categories = list(self.emission_df["category"].unique())
+        self.countries = self.emission_df["country_or_area"].unique()
+        self.store = dp.EmissionStore(self.emission_df)
+
+        if cf.chunked_loading != True:
+            # chunked loading already split the data into the interesting gases
+            self.working_dict = dp.seperate_categories(self.emission_df, choose_labels=self.gases)
+        return self.working_dict
+
+    def analyze(self):
+        """
+        find the biggest polluters and best practise examples, rank the countries for the
+        ranking_metrics (see ranking) and export both as one table (Data_preperation.export_results)
+        """
+        import ranking as rk
+
+        if self.working_dict is None:
+            self.run_stage("prepare")
+        self.results = dp.calc_Results(self.store, self.gases, self.countries, k=cf.ranking_k,
+                                       years=cf.ranking_years)
+        self.rankings = rk.rank_many(self.store, cf.ranking_metrics, gases=self.gases)
+        dp.export_results(self.results, rankings=self.rankings)
+        return self.results
+
+    def correlate(self):
+        """
+        correlation and distance matrices between all countries for every interesting gas
+        (see correlation.similarity_matrices)
+        """
+        import correlation as co
+
+        if self.working_dict is None:
+            self.run_stage("prepare")
+        self.similarity = co.similarity_matrices(self.emission_df, self.gases, cf.similarity_metrics)
+        return self.similarity
+
+    def interpolate(self):
+        """
+        polynomial interpolation of the series to get more values. Only the series of
+        forecast_country and forecast_gas, or all series for the batch forecast.
+        """
+        import forecasting as fc
+
+        if self.working_dict is None:
+            self.run_stage("prepare")
+        if self.batch:
+            self.series_dict = fc.build_all_series(self.working_dict, cf.interpolation_intervall)
+        else:
+            self.series_dict = fc.build_series(self.store, [(cf.forecast_country, cf.forecast_gas)],
+                                               cf.interpolation_intervall)
+        return self.series_dict
+
+    def forecast(self):
+        """
+        SARIMAX prediction: train, test, backtest and forecast of the forecast_country/forecast_gas
+        series and for the batch forecast a table of all series
+        """
+        import forecasting as fc
+
+        if self.series_dict is None:
+            self.run_stage("interpolate")
+        key = (cf.forecast_country, cf.forecast_gas)
+        if key in self.series_dict:
+            self.prediction = fc.fit_forecast(self.series_dict[key])
+        if self.batch:
+            self.forecast_table = fc.forecast_series(self.series_dict, workers=self.workers)
+            fc.save_forecast_table(self.forecast_table)
+        return self.prediction
+
+    def report(self):
+        """
+        plot the prediction and, if plot_all_countries is set, all gases of all countries
+        """
+        import plotting as pt
+
+        if cf.plot_all_countries == True:
+            if self.working_dict is None:
+                self.run_stage("prepare")
+            pt.plot_all_countries_report(self.emission_df, self.categories, workers=self.report_workers)
+
+        if self.prediction is None:
+            self.run_stage("forecast")
+        if self.prediction is not None:
+            train, test, backtest_df, forecast_df = self.prediction
+            pred_title_name = "prediction of SF6 emission within the EU for the next 10 years "
+            pt.plot_prediction(train, test, backtest_df, forecast_df, title=pred_title_name,
+                               headless=self.headless)
+
+    def run(self, stages=None):
+        """
+        run the given stages in the order of STAGES, by default the stages set in config_file.
+        Memoized stages load their stored results instead of running; the stages before them
+        only run if a later stage needs to run.
+        :param stages: list of str
+        """
+        if stages is None:
+            stages = default_stages()
+        for stage in STAGES:
+            if stage in stages:
+                self.run_stage(stage)
+        if instrumentation.enabled():
+            instrumentation.write_traces()
+        return self
+
+    def run_stage(self, stage):
+        """
+        run one stage (and the stages it depends on) or load its memoized result
+        :param stage: str
+        """
+        if stage in self.finished:
+            return
+        if self.memoize and stage in STAGE_OUTPUTS:
+            stage_path = Path(cf.stage_cache_dir).joinpath(stage + "_" + self.fingerprint(stage) + ".pickle")
+            if stage_path.exists():
+                with instrumentation.measure(stage + " (memoized)", category="stage"):
+                    with open(stage_path, "rb") as file:
+                        for name, value in pickle.load(file).items():
+                            setattr(self, name, value)
+                self.finished.add(stage)
+                return
+
+        for dependency in STAGE_DEPENDENCIES[stage]:
+            self.run_stage(dependency)
+        with instrumentation.measure(stage, category="stage", profile=True) as record:
+            getattr(self, stage)()
+            record["rows"] = instrumentation.count_rows(self.emission_df)
+        self.finished.add(stage)
+
+        if self.memoize and stage in STAGE_OUTPUTS:
+            stage_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(stage_path, "wb") as file:
+                pickle.dump({name: getattr(self, name) for name in STAGE_OUTPUTS[stage]}, file)
+            _remove_old_stage_files(stage, cf.stage_cache_keep)
+
+    def fingerprint(self, stage):
+        """
+        hash of the settings of a stage and the fingerprints of all stages it depends on.
+        The load stage also hashes path, size and modification time of the data file. The cache
+        version and the source of the stage method make old stage files invalid after code changes.
+        :param stage: str
+        :returns: str
+        """
+        sha = hashlib.sha256(stage.encode())
+        sha.update(repr(STAGE_CACHE_VERSION).encode())
+        sha.update(inspect.getsource(getattr(Pipeline, stage)).encode())
+        for name in STAGE_PARAMETERS[stage]:
+            value = getattr(self, name) if hasattr(self, name) else getattr(cf, name)
+            sha.update(repr((name, value)).encode())
+        if stage == "load":
+            stat = Path(self.data_path).stat()
+            sha.update(repr((stat.st_size, stat.st_mtime_ns)).encode())
+        for dependency in STAGE_DEPENDENCIES[stage]:
+            sha.update(self.fingerprint(dependency).encode())
+        return sha.hexdigest()[:16]
+
+
+def _remove_old_stage_files(stage, keep):
+    """
+    only keep the newest results of a stage in stage_cache_dir
+    :param stage: str
+    :param keep: int
+    """
+    stage_files = sorted(Path(cf.stage_cache_dir).glob(stage + "_*.pickle"),
+                         key=lambda stage_path: stage_path.stat().st_mtime, reverse=True)
+    for stage_path in stage_files[keep:]:
+        stage_path.unlink(missing_ok=True)
+
+
+def default_stages():
+    """
+    stages of a run without command line arguments
+    :returns: list of str
+    """
+    stages = ["load", "prepare"]
+    if cf.make_analysis == True:
+        stages.append("analyze")
+    if cf.make_correlation == True:
+        stages.append("correlate")
+    return stages + ["interpolate", "forecast", "report"]
+
+
+def main(argv=None):
+    """
+    command line entry point
+    :param argv: list of str, default sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Greenhouse gas emission analysis and forecasting")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=None,
+                        help="stages to run (their dependencies run automatically)")
+    parser.add_argument("--data", default=cf.emission_data_path, help="csv file of the emission data")
+    parser.add_argument("--batch", action="store_true", default=cf.batch_forecast,
+                        help="forecast all countries and gases")
+    parser.add_argument("--workers", type=int, default=cf.forecast_workers, help="number of worker processes")
+    parser.add_argument("--headless", action="store_true", default=cf.headless_plots,
+                        help="only save the plots, do not open them")
+    parser.add_argument("--memoize", action="store_true", default=cf.memoize_stages,
+                        help="reuse the stored results of unchanged stages")
+    parser.add_argument("--delta", default=None,
+                        help="csv file with new rows, only updates the stored analysis results")
+    parser.add_argument("--trace", action="store_true", default=cf.instrumentation,
+                        help="record time and memory of the stages in trace_dir")
+    parser.add_argument("--profile", choices=STAGES, default=cf.profile_stage,
+                        help="profile one stage (needs --trace)")
+    args = parser.parse_args(argv)
+    cf.instrumentation = args.trace
+    cf.profile_stage = args.profile
+
+    if args.delta is not None:
+        import incremental
+        incremental.apply_delta(args.delta, data_path=args.data)
+        print("DONE JUHU!")
+        return None
+
+    pipeline = Pipeline(data_path=args.data, batch=args.batch, workers=args.workers, headless=args.headless,
+                        memoize=args.memoize)
+    pipeline.run(args.stages)
+    print("DONE JUHU!")
+    return pipeline
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+## module:: Data challenge backtesting
+#     :platform:   Windows
+#     :synopsis:   rolling origin cross validation of the SARIMAX forecasts
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import config_file as cf
+import forecasting as fc
+
+######################################################################
+
+def backtest_origins(n_obs, n_origins, horizon, step):
+    """
+    end positions of the training data (forecast origins) of all folds, the last origin leaves
+    exactly horizon observations for the evaluation
+    :param n_obs: int length of the series
+    :param n_origins: int
+    :param horizon: int
+    :param step: int observations between two origins
+    :returns origins: list of int
+    """
+    last_origin = n_obs - horizon
+    origins = [last_origin - step*i for i in reversed(range(n_origins))]
+    if origins[0] < 3:
+        raise ValueError(f"series of length {n_obs} is too short for {n_origins} origins "
+                         f"with horizon {horizon} and step {step}")
+    return origins
+
+
+def _fold_forecast(task):
+    """
+    fit one fold and forecast its horizon (used in the process pool)
+    :param task: tuple (train, horizon, order, seasonal_order, model_cache)
+    :returns prediction: pandas.Series
+    """
+    train, horizon, order, seasonal_order, model_cache = task
+    sarimax_results = fc.fit_sarimax(train, order, seasonal_order, model_cache=model_cache)
+    return sarimax_results.forecast(steps=horizon)
+
+
+def rolling_origin_backtest(y, **kwargs):
+    """
+    rolling origin cross validation: the model is trained up to every origin and forecasts the
+    next horizon steps. The training data grows with every origin ("expanding") or keeps the
+    length of the first training set ("sliding"). With refit the folds are fitted in a process
+    pool, without refit the model is fitted once and only filtered over the new observations.
+
+    :param y: pandas.Series
+    :kwarg n_origins: int number of folds
+    :kwarg horizon: int forecasted steps per fold
+    :kwarg step: int observations between two origins
+    :kwarg window: str "expanding" or "sliding"
+    :kwarg refit: bool
+    :kwarg order: tuple (p, d, q)
+    :kwarg seasonal_order: tuple (P, D, Q, s)
+    :kwarg workers: int worker processes for refitting, 1 fits in this process
+    :kwarg model_cache: Windows.Path directory for fitted models or None
+    :returns errors, predictions: errors per horizon (mae, rmse, mape) and all fold predictions
+    """
+    n_origins = kwargs.get("n_origins", cf.backtest_origins)
+    horizon = kwargs.get("horizon", cf.backtest_horizon)
+    step = kwargs.get("step", 1)
+    window = kwargs.get("window", cf.backtest_window)
+    refit = kwargs.get("refit", cf.backtest_refit)
+    order = kwargs.get("order", cf.sarimax_order)
+    seasonal_order = kwargs.get("seasonal_order", cf.seasonal_order)
+    workers = kwargs.get("workers", cf.forecast_workers) or os.cpu_count()
+    model_cache = kwargs.get("model_cache", cf.model_cache_dir if cf.use_model_cache else None)
+
+    if window not in ["expanding", "sliding"]:
+        raise ValueError(f"unknown window: {window}, choose expanding or sliding")
+    origins = backtest_origins(len(y), n_origins, horizon, step)
+    train_length = origins[0]
+
+    def train_slice(origin):
+        start = 0 if window == "expanding" else origin - train_length
+        return y[start:origin]
+
+    if refit:
+        tasks = [(train_slice(origin), horizon, order, seasonal_order, model_cache) for origin in origins]
+        if workers == 1:
+            predictions = list(map(_fold_forecast, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+                predictions = list(executor.map(_fold_forecast, tasks))
+    else:
+        first_results = fc.fit_sarimax(train_slice(origins[0]), order, seasonal_order, model_cache=model_cache)
+        predictions = [first_results.forecast(steps=horizon)]
+        for origin in origins[1:]:
+            if window == "expanding":
+                # keep the fitted parameters and only run the filter over the new observations
+                fold_results = first_results.append(y[origins[0]:origin], refit=False)
+            else:
+                fold_results = first_results.apply(train_slice(origin), refit=False)
+            predictions.append(fold_results.forecast(steps=horizon))
+
+    folds = []
+    for fold, (origin, prediction) in enumerate(zip(origins, predictions)):
+        actual = y[origin:origin + horizon]
+        folds.append(pd.DataFrame({
+            "fold": fold,
+            "origin": y.index[origin - 1],
+            "horizon": np.arange(1, horizon + 1),
+            "year": actual.index,
+            "y": actual.to_numpy(),
+            "prediction": np.asarray(prediction),
+        }))
+    predictions_df = pd.concat(folds, ignore_index=True)
+    return forecast_errors(predictions_df), predictions_df
+
+
+def forecast_errors(predictions_df):
+    """
+    mean absolute error, root mean squared error and mean absolute percentage error (in %) per
+    forecast horizon. Actual values of 0 are left out of the percentage error.
+    :param predictions_df: pandas.DataFrame with the columns horizon, y and prediction
+    :returns errors: pandas.DataFrame
+    """
+    error = predictions_df["prediction"] - predictions_df["y"]
+    actual = predictions_df["y"].where(predictions_df["y"] != 0)
+    errors = pd.DataFrame({
+        "horizon": predictions_df["horizon"],
+        "abs_error": error.abs(),
+        "squared_error": error**2,
+        "percentage_error": (error / actual).abs() * 100,
+    }).groupby("horizon")
+    return pd.DataFrame({
+        "mae": errors["abs_error"].mean(),
+        "rmse": np.sqrt(errors["squared_error"].mean()),
+        "mape": errors["percentage_error"].mean(),
+        "folds": errors["abs_error"].count(),
+    })
@@ -11,8 +11,50 @@ from datetime import date
 
 filename = "Greenhouse.csv"
 emission_data_path = Path(__file__).parents[0].joinpath("Data/" + filename)
+# store the cleaned data as feather file for faster loading (needs pyarrow)
+use_data_cache = False
+cache_dir = Path(__file__).parents[0].joinpath("Cache")
+# read the csv file in chunks and only keep interesting_gases (and load_countries, None for all)
+# in compact dtypes, value_dtype "float32" halves the memory of the values
+chunked_loading = False
+load_chunksize = 100000
+load_countries = None
+value_dtype = "float64"
+# store the results of the pipeline stages and only rerun stages after a changed setting
+memoize_stages = False
+stage_cache_dir = Path(__file__).parents[0].joinpath("Cache/stages")
+stage_cache_keep = 3
+# running aggregates of the analysis, updated with python Greenhouse.py --delta new_rows.csv
+result_store_path = Path(__file__).parents[0].joinpath("Cache/result_store.pickle")
+# record time, memory and rows of the pipeline functions and stages as json lines and chrome trace
+# (chrome://tracing) in trace_dir, trace_memory also traces the python allocations (slower)
+instrumentation = False
+trace_memory = False
+trace_dir = Path(__file__).parents[0].joinpath("Results/traces")
+# profile one stage with "cProfile" or "pyinstrument", e.g. profile_stage = "analyze"
+profile_stage = None
+profiler = "cProfile"
+# local json service (python service.py), cache of rankings and forecasts: entries and seconds
+service_host = "127.0.0.1"
+service_port = 8050
+service_cache_size = 128
+service_cache_ttl = 3600
 
 interesting_gases = ["carbon_dioxide_co2", "methane_ch4_emissions", "sulphur_hexafluoride_sf6"]
+# rankings of the analysis (ranking.py): k countries per gas for the registered metrics (largest and
+# smallest), years (first, last) limits the years, None uses all
+ranking_k = 3
+ranking_years = None
+ranking_metrics = ["total", "cagr", "first_to_last", "yoy_delta"]
+# similarity of the countries per gas (correlation.py), metrics "pearson", "spearman", "growth"
+# (correlation of the yearly growth rates), "euclidean" and "dtw" (distances of the z-scored series
+# with similarity_normalize). Blocks of similarity_block_size countries run in similarity_workers processes
+make_correlation = False
+similarity_metrics = ["pearson", "growth", "euclidean"]
+similarity_normalize = True
+similarity_workers = 1
+similarity_block_size = 256
+similarity_cache_dir = Path(__file__).parents[0].joinpath("Cache/similarity")
 ##########################################################################
 # old prediction section
 #train / test split
@@ -21,6 +63,47 @@ interpolation_intervall = 3
 # how many steps to predict
 prediction_steps = 5
 
+##########################################################################
+# SARIMAX prediction section
+# series of the single prediction
+forecast_country = "European Union"
+forecast_gas = "sulphur_hexafluoride_sf6"
+train_percent = 0.85
+sarimax_order = (1, 1, 0)
+seasonal_order = (0, 0, 0, 0)
+# 30 steps with an interpolation intervall of 3 = 10 years
+forecast_steps = 30
+# forecast all countries and gases in a process pool, None uses all cores
+batch_forecast = False
+forecast_workers = None
+blas_threads = 1
+# engine of the batch forecast: "sarimax" or "vectorized" (ARIMA(p, d, 0) of all series at once
+# with numpy, only non seasonal orders with q = 0)
+forecast_engine = "sarimax"
+# prediction intervals of the backtest and forecast (alpha = 1 - confidence), with simulate_paths > 0
+# also the path_quantiles of that many simulated paths
+forecast_alpha = 0.05
+simulate_paths = 0
+path_quantiles = [0.05, 0.5, 0.95]
+# reuse fitted models of unchanged series, oldest models are deleted above model_cache_size bytes
+use_model_cache = False
+model_cache_dir = Path(__file__).parents[0].joinpath("Cache/models")
+model_cache_size = 500 * 1024**2
+# search the orders per series instead of using sarimax_order ("stepwise" or "grid",
+# criterion "aic", "bic" or backtest error "mae", "rmse"), seasonal period s <= 1 means no seasonality
+auto_order = False
+order_search = "stepwise"
+order_criterion = "aic"
+order_search_maxiter = 50
+max_order = (3, 2, 3)
+max_seasonal_order = (1, 1, 1, 0)
+# rolling origin backtesting, window "expanding" or "sliding",
+# without refit the model of the first fold is only filtered over the new data
+backtest_origins = 5
+backtest_horizon = 6
+backtest_window = "expanding"
+backtest_refit = True
+
 ##########################################################################
 #plotting parameters
 current_date = date.today().strftime("%d_%m_%Y")
@@ -28,8 +111,32 @@ current_date = date.today().strftime("%d_%m_%Y")
 save_train_test_name = "train_test_" + current_date + ".html"
 save_all_gases_name = "all_gases_" + current_date + ".html"
 save_prediction_name = "prediction_" + current_date +".html"
+# forecast table of the batch forecast as .csv and/or .parquet (add "parquet" only with pyarrow installed)
+save_forecast_name = "forecasts_" + current_date
+forecast_formats = ["csv"]
+# analysis results as one long table (metric, gas, rank, country, year, value) in save_results_name
+# .csv/.parquet (add "parquet" only with pyarrow installed), optional also appended to a sqlite
+# (or .duckdb) database file
+save_results_name = "results_" + current_date
+result_formats = ["csv"]
+result_database = None
+save_report_name = "all_gases_" + current_date + ".html"
+
+# only save the plots without opening them (for servers), optional also as "png" or "svg"
+# image (needs selenium and a webdriver)
+headless_plots = False
+plot_image_format = None
+# long series: WebGL and downsampling ("lttb" or "minmax") to at most plot_point_budget points per line
+large_data_plots = False
+plot_point_budget = 2000
+plot_downsampling = "lttb"
 
 plot_all_countries = False
+# report of all countries: "tabs" (one file) or "pages" (one file per country),
+# BokehJS from "cdn", "relative" (local bokeh installation) or "inline" in every file
+report_mode = "tabs"
+report_resources = "cdn"
+report_workers = None
 make_analysis = True
 plot_analysis = True
 
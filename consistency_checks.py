@@ -0,0 +1,287 @@
+## module:: Data challenge consistency checks
+#     :platform:   Windows
+#     :synopsis:   compare the fast implementations with their reference implementations
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+python consistency_checks.py                          all checks on synthetic data
+python consistency_checks.py --countries 20 --years 30
+python consistency_checks.py --data Data/Greenhouse.csv   engine and incremental checks on the real data
+
+every check prints the largest differences and the exit code is 1 if one of them is above the
+tolerance
+"""
+import argparse
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import Data_preperation as dp
+import config_file as cf
+from pipeline_benchmark import make_synthetic_data
+
+######################################################################
+
+def synthetic_emissions(n_countries=8, n_years=25, **kwargs):
+    """
+    prepared synthetic emission data (pipeline_benchmark.make_synthetic_data)
+    :param n_countries: int
+    :param n_years: int
+    :kwarg seed: int
+    :returns emission_df: pandas.DataFrame
+    """
+    raw_data = make_synthetic_data(n_countries, 10, n_years, seed=kwargs.get("seed", 0))
+    return dp.prepare_emission_data(raw_data.astype({"year": "int16"}))
+
+
+def check_vector_arima(emission_df, **kwargs):
+    """
+    AR coefficients and forecasts of vector_arima against statsmodels SARIMAX
+    (vector_arima.cross_check) on the interpolated series of the interesting gases. Series
+    without a frequency (intervall 5) have to be rejected by both engines with a ValueError.
+    :param emission_df: pandas.DataFrame
+    :kwarg orders: list of (p, d, 0)
+    :kwarg tolerance: float largest allowed coefficient and relative forecast difference
+    :returns failed: list of str
+    """
+    import forecasting as fc
+    import vector_arima as va
+
+    orders = kwargs.get("orders", [(1, 1, 0), (2, 1, 0), (1, 0, 0)])
+    tolerance = kwargs.get("tolerance", 1e-4)
+
+    working_dict = dp.seperate_categories(emission_df, choose_labels=cf.interesting_gases)
+    series_dict = fc.build_all_series(working_dict, cf.interpolation_intervall)
+    failed = []
+    for order in orders:
+        comparison = va.cross_check(series_dict, order=order)
+        ar_difference = comparison["ar_difference"].max()
+        forecast_difference = comparison["forecast_difference"].max()
+        print(f"vector_arima {str(order):<10} ar {ar_difference:10.2e}   forecast {forecast_difference:10.2e}")
+        if ar_difference > tolerance or forecast_difference > tolerance:
+            failed.append(f"vector_arima {order}")
+
+    irregular_dict = fc.build_all_series(working_dict, 5)
+    for engine in ["sarimax", "vectorized"]:
+        try:
+            fc.forecast_series(irregular_dict, engine=engine, workers=1)
+        except ValueError:
+            print(f"vector_arima no frequency  {engine:<10} rejected")
+        else:
+            print(f"vector_arima no frequency  {engine:<10} not rejected")
+            failed.append(f"vector_arima no frequency {engine}")
+    return failed
+
+
+def check_correlation(emission_df, **kwargs):
+    """
+    correlation.pairwise against pandas corr (pearson, spearman, growth) and brute force
+    euclidean and dtw distances, for every interesting gas. Some years are removed at random to
+    check the handling of missing values (dtw fills them first, so it is checked on the filled rows).
+    :param emission_df: pandas.DataFrame
+    :kwarg missing_share: float share of removed values
+    :kwarg window: int dtw window checked next to no window
+    :kwarg tolerance: float largest allowed absolute difference
+    :kwarg seed: int
+    :returns failed: list of str
+    """
+    import correlation as co
+
+    missing_share = kwargs.get("missing_share", 0.1)
+    window = kwargs.get("window", 3)
+    # euclidean uses matrix products, near zero distance the square root magnifies the rounding to ~1e-7
+    tolerance = kwargs.get("tolerance", 1e-6)
+    rng = np.random.default_rng(kwargs.get("seed", 0))
+
+    failed = []
+    for gas in cf.interesting_gases:
+        values_df = co.country_matrix(emission_df, gas)
+        gaps_df = values_df.mask(rng.random(values_df.shape) < missing_share)
+        normalized_df = gaps_df.sub(gaps_df.mean(axis=1), axis=0).div(gaps_df.std(axis=1, ddof=0), axis=0)
+        growth_df = gaps_df.diff(axis=1) / gaps_df.shift(axis=1)
+        filled = normalized_df.ffill(axis=1).bfill(axis=1).to_numpy()
+
+        comparisons = [
+            ("pearson", co.pairwise(gaps_df.to_numpy(), "pearson", workers=1), gaps_df.T.corr()),
+            ("spearman", co.pairwise(gaps_df.to_numpy(), "spearman", workers=1),
+             gaps_df.T.corr(method="spearman")),
+            ("spearman full", co.pairwise(values_df.to_numpy(), "spearman", workers=1),
+             values_df.T.corr(method="spearman")),
+            ("growth", co.pairwise(gaps_df.to_numpy(), "growth", workers=1), growth_df.T.corr()),
+            ("euclidean", co.pairwise(gaps_df.to_numpy(), "euclidean", normalize=True, workers=1),
+             _brute_force(normalized_df.to_numpy(), _euclidean_pair)),
+            ("dtw", co.pairwise(gaps_df.to_numpy(), "dtw", normalize=True, workers=1),
+             _brute_force(filled, _dtw_pair)),
+            (f"dtw window {window}", co.pairwise(gaps_df.to_numpy(), "dtw", normalize=True, window=window, workers=1),
+             _brute_force(filled, lambda left, right: _dtw_pair(left, right, window))),
+        ]
+        for metric, fast, reference in comparisons:
+            difference = _largest_difference(fast, np.asarray(reference))
+            print(f"correlation {gas:<24} {metric:<14} {difference:10.2e}")
+            if difference > tolerance:
+                failed.append(f"correlation {gas} {metric}")
+    return failed
+
+
+def _largest_difference(fast, reference):
+    """
+    largest absolute difference, inf if the missing values are not the same
+    """
+    if not np.array_equal(np.isnan(fast), np.isnan(reference)):
+        return np.inf
+    both = ~np.isnan(fast)
+    if not both.any():
+        return 0.0
+    return np.abs(fast[both] - reference[both]).max()
+
+
+def _brute_force(matrix, pair_function):
+    """
+    pair_function of every pair of rows, one pair after the other
+    """
+    return np.array([[pair_function(left, right) for right in matrix] for left in matrix])
+
+
+def _euclidean_pair(left, right):
+    """
+    euclidean distance over the common years, scaled up to all years
+    """
+    common = np.isfinite(left) & np.isfinite(right)
+    return np.sqrt(((left[common] - right[common])**2).sum() * len(left) / common.sum())
+
+
+def _dtw_pair(left, right, window=None):
+    """
+    textbook dynamic time warping with an optional Sakoe-Chiba window
+    """
+    n_years = len(left)
+    window = n_years if window is None else window
+    table = np.full((n_years + 1, n_years + 1), np.inf)
+    table[0, 0] = 0.0
+    for i in range(1, n_years + 1):
+        for j in range(max(1, i - window), min(n_years, i + window) + 1):
+            table[i, j] = abs(left[i - 1] - right[j - 1]) + min(table[i - 1, j], table[i, j - 1], table[i - 1, j - 1])
+    return table[n_years, n_years]
+
+
+def check_engines(emission_df, **kwargs):
+    """
+    calc_Results engine "loop" against "vectorized", with a dataframe and an EmissionStore and
+    with all years and a window of years. The total and improvement rankings have to be equal
+    including the order of ties, tied years of max-year/min-year may be ordered differently.
+    :param emission_df: pandas.DataFrame prepared emission data
+    :kwarg k: int
+    :kwarg years: list of (first year, last year) or None
+    :returns failed: list of str
+    """
+    k = kwargs.get("k", cf.ranking_k)
+    windows = kwargs.get("years", [None, (1995, None)])
+
+    countries = emission_df["country_or_area"].unique()
+    inputs = {"dataframe": emission_df, "store": dp.EmissionStore(emission_df)}
+    failed = []
+    for input_name, em_data in inputs.items():
+        for years in windows:
+            loop = dp.calc_Results(em_data, cf.interesting_gases, countries, engine="loop", k=k, years=years)
+            vectorized = dp.calc_Results(em_data, cf.interesting_gases, countries, engine="vectorized",
+                                         k=k, years=years)
+            for rating, gas_results in loop.items():
+                for gas, expected in gas_results.items():
+                    result = vectorized[rating][gas]
+                    if isinstance(expected, pd.DataFrame):
+                        same = _same_ranking(expected, result)
+                    else:
+                        same = expected.index.equals(result.index) and np.allclose(expected, result)
+                    print(f"engines {input_name:<10} {str(years):<12} {rating:<14} {gas:<24} "
+                          f"{'ok' if same else 'different'}")
+                    if not same:
+                        failed.append(f"engines {input_name} {years} {rating} {gas}")
+    return failed
+
+
+def check_incremental(raw_data, **kwargs):
+    """
+    incremental.ResultStore against calc_Results on all rows. The raw data is split by year into
+    a base and a delta: the newest year as release on top of the older years, and the older
+    years added to the newer ones (the csv is sorted newest year first).
+    :param raw_data: pandas.DataFrame raw emission data (load_csv_data)
+    :kwarg k: int
+    :kwarg years: tuple (first year, last year) or None
+    :returns failed: list of str
+    """
+    import incremental
+
+    k = kwargs.get("k", cf.ranking_k)
+    years = kwargs.get("years", None)
+
+    last_year = raw_data["year"].max()
+    middle_year = int(raw_data["year"].median())
+    splits = {
+        "new release": (raw_data[raw_data["year"] < last_year], raw_data[raw_data["year"] == last_year]),
+        "older years": (raw_data[raw_data["year"] >= middle_year], raw_data[raw_data["year"] < middle_year]),
+    }
+    failed = []
+    for split_name, (base, delta) in splits.items():
+        all_rows = dp.prepare_emission_data(pd.concat([base, delta], ignore_index=True))
+        reference = dp.calc_Results(all_rows, cf.interesting_gases, all_rows["country_or_area"].unique(),
+                                    k=k, years=years)
+        result_store = incremental.ResultStore(cf.interesting_gases, k=k, years=years)
+        result_store.update(dp.prepare_emission_data(base))
+        result_store.update(dp.prepare_emission_data(delta))
+        results_dict = result_store.results_dict()
+
+        for rating, gas_results in reference.items():
+            for gas, expected in gas_results.items():
+                same = _same_ranking(expected, results_dict[rating][gas])
+                print(f"incremental {split_name:<12} {rating:<14} {gas:<24} {'ok' if same else 'different'}")
+                if not same:
+                    failed.append(f"incremental {split_name} {rating} {gas}")
+    return failed
+
+
+def _same_ranking(expected, result):
+    """
+    same values (and labels of the total and improvement rankings), tied entries may be ordered
+    differently
+    """
+    if isinstance(expected, pd.DataFrame):
+        return len(expected) == len(result) and \
+            np.allclose(np.sort(expected["value"].to_numpy()), np.sort(result["value"].to_numpy()))
+    return len(expected) == len(result) and set(expected.index) == set(result.index) and \
+        np.allclose(np.sort(expected.to_numpy()), np.sort(result.to_numpy()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="consistency checks of the fast implementations")
+    parser.add_argument("--countries", type=int, default=8)
+    parser.add_argument("--years", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data", default=cf.emission_data_path,
+                        help="csv file for the incremental check, synthetic data if it does not exist")
+    args = parser.parse_args(argv)
+
+    emission_df = synthetic_emissions(args.countries, args.years, seed=args.seed)
+    failed = check_vector_arima(emission_df)
+    failed += check_correlation(emission_df, seed=args.seed)
+
+    if Path(args.data).exists():
+        raw_data = dp.load_csv_data(args.data)
+    else:
+        print(f"{args.data} not found, incremental check on synthetic data")
+        raw_data = make_synthetic_data(args.countries, 10, args.years, seed=args.seed).astype({"year": "int16"})
+    failed += check_engines(dp.prepare_emission_data(raw_data))
+    failed += check_incremental(raw_data)
+    failed += check_incremental(raw_data, k=5, years=(1995, None))
+    if len(failed) > 0:
+        print("failed: " + ", ".join(failed))
+        return 1
+    print("all checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
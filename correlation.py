@@ -0,0 +1,336 @@
+## module:: Data challenge correlation
+#     :platform:   Windows
+#     :synopsis:   correlation and distance matrices between the countries of one gas
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+every gas is pivoted into a country x year matrix. All metrics compare all pairs of rows at once:
+correlations and euclidean distances with matrix products over the years both countries have values
+for (pairwise complete, spearman also ranks only these years), dynamic time warping with one dynamic programming table for a whole block
+of pairs. Blocks of rows can be calculated in worker processes and the finished matrices are cached
+in similarity_cache_dir.
+
+    matrix_df = similarity_matrix(emission_df, "carbon_dioxide_co2", "pearson")
+    peers(matrix_df, "European Union", k=5)
+"""
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config_file as cf
+from instrumentation import instrumented
+
+# metrics, which are similarities (higher is closer), the others are distances
+correlation_metrics = ["pearson", "spearman", "growth"]
+distance_metrics = ["euclidean", "dtw"]
+# part of the cache keys, increase it when a metric changes its results
+similarity_version = 2
+
+######################################################################
+
+def country_matrix(em_data, gas):
+    """
+    values of one gas as country x year matrix, NaN for missing years
+    :param em_data: pandas.DataFrame (compact schema of prepare_emission_data)
+    :param gas: str short category label
+    :returns: pandas.DataFrame countries as index, int years as columns
+    """
+    one_gas = em_data[em_data["category"] == gas]
+    matrix = one_gas.pivot_table(index="country_or_area", columns="year", values="value",
+                                 aggfunc="first", observed=True)
+    matrix.index = matrix.index.astype(str)
+    return matrix.sort_index(axis=1).astype("float64")
+
+
+def _pairwise_sums(left, right):
+    """
+    sums over the years, where both rows have values, for all pairs of rows
+    :returns count, sum_left, sum_right, sum_left2, sum_right2, sum_product: numpy.ndarray (n_left, n_right)
+    """
+    left_mask, right_mask = np.isfinite(left), np.isfinite(right)
+    left_values, right_values = np.where(left_mask, left, 0.0), np.where(right_mask, right, 0.0)
+    left_mask, right_mask = left_mask.astype("float64"), right_mask.astype("float64")
+    return (left_mask @ right_mask.T,
+            left_values @ right_mask.T,
+            left_mask @ right_values.T,
+            left_values**2 @ right_mask.T,
+            left_mask @ (right_values**2).T,
+            left_values @ right_values.T)
+
+
+def pearson(left, right):
+    """
+    pearson correlation of all pairs of rows over their common years, NaN with less than 3 common years
+    :param left: numpy.ndarray (n_left, n_years)
+    :param right: numpy.ndarray (n_right, n_years)
+    :returns: numpy.ndarray (n_left, n_right)
+    """
+    count, sum_left, sum_right, sum_left2, sum_right2, sum_product = _pairwise_sums(left, right)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = sum_product - sum_left*sum_right/count
+        variance = (sum_left2 - sum_left**2/count) * (sum_right2 - sum_right**2/count)
+        correlation = covariance / np.sqrt(variance)
+    correlation[(count < 3) | ~(variance > 0)] = np.nan
+    return np.clip(correlation, -1, 1)
+
+
+def spearman(left, right, **kwargs):
+    """
+    spearman correlation of all pairs of rows, ranked over the common years of every pair like
+    pandas corr. Without missing values the rows are ranked once and correlated with pearson,
+    otherwise the ranks are counted for a block of pairs at once.
+    :param left: numpy.ndarray (n_left, n_years)
+    :param right: numpy.ndarray (n_right, n_years)
+    :kwarg block_size: int right rows per step, limits the (n_left, block_size, n_years) arrays
+    :returns: numpy.ndarray (n_left, n_right)
+    """
+    block_size = kwargs.get("block_size", cf.similarity_block_size)
+    if np.isfinite(left).all() and np.isfinite(right).all():
+        return pearson(rank_rows(left), rank_rows(right))
+
+    left_compare = _rank_comparisons(left)
+    right_compare = _rank_comparisons(right)
+    left_mask = np.isfinite(left)
+    blocks = []
+    for start in range(0, len(right), block_size):
+        stop = start + block_size
+        # years both rows have, for every pair of the block
+        common = (left_mask[:, None, :] & np.isfinite(right[None, start:stop])).astype("float64")
+        # average rank of every year within the common years: smaller values + (equal values + 1) / 2
+        left_ranks = np.einsum("ijs,ist->ijt", common, left_compare) + 0.5
+        right_ranks = np.einsum("ijs,jst->ijt", common, right_compare[start:stop]) + 0.5
+        blocks.append(_masked_pearson(left_ranks, right_ranks, common))
+    if len(blocks) == 0:
+        return np.zeros((len(left), 0))
+    return np.concatenate(blocks, axis=1)
+
+
+def _rank_comparisons(matrix):
+    """
+    1 if the value of year s is smaller than the one of year t, 0.5 if it is equal, else 0
+    :returns: numpy.ndarray (n_rows, n_years s, n_years t)
+    """
+    smaller = (matrix[:, :, None] < matrix[:, None, :]).astype("float64")
+    equal = (matrix[:, :, None] == matrix[:, None, :]).astype("float64")
+    return smaller + 0.5*equal
+
+
+def _masked_pearson(left, right, mask):
+    """
+    pearson correlation of left[i, j] and right[i, j] over the years where mask is 1, NaN with less
+    than 3 years
+    :param left, right, mask: numpy.ndarray (n_left, n_right, n_years)
+    :returns: numpy.ndarray (n_left, n_right)
+    """
+    count = mask.sum(axis=2)
+    left, right = left*mask, right*mask
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sum_left, sum_right = left.sum(axis=2), right.sum(axis=2)
+        covariance = (left*right).sum(axis=2) - sum_left*sum_right/count
+        variance = ((left**2).sum(axis=2) - sum_left**2/count) * ((right**2).sum(axis=2) - sum_right**2/count)
+        correlation = covariance / np.sqrt(variance)
+    correlation[(count < 3) | ~(variance > 0)] = np.nan
+    return np.clip(correlation, -1, 1)
+
+
+def rank_rows(matrix):
+    """
+    ranks of the values of every row (average ranks for ties), NaN stays NaN
+    """
+    return pd.DataFrame(matrix).rank(axis=1).to_numpy()
+
+
+def growth_rates(matrix):
+    """
+    relative change to the previous year of every row
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = np.diff(matrix, axis=1) / matrix[:, :-1]
+    growth[~np.isfinite(growth)] = np.nan
+    return growth
+
+
+def zscore_rows(matrix):
+    """
+    every row minus its mean divided by its standard deviation (ignoring NaN)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.nanmean(matrix, axis=1, keepdims=True)
+        std = np.nanstd(matrix, axis=1, keepdims=True)
+        return (matrix - mean) / np.where(std > 0, std, 1.0)
+
+
+def euclidean(left, right):
+    """
+    euclidean distance of all pairs of rows over their common years, scaled up to all years
+    (like sklearn nan_euclidean_distances)
+    :returns: numpy.ndarray (n_left, n_right)
+    """
+    count, _, _, sum_left2, sum_right2, sum_product = _pairwise_sums(left, right)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        squared = np.maximum(sum_left2 + sum_right2 - 2*sum_product, 0) * left.shape[1] / count
+    return np.sqrt(squared)
+
+
+def fill_rows(matrix):
+    """
+    fill missing years with the neighbouring years of the same row (for dtw)
+    """
+    return pd.DataFrame(matrix).ffill(axis=1).bfill(axis=1).to_numpy()
+
+
+def dtw(left, right, **kwargs):
+    """
+    dynamic time warping distance of all pairs of rows. The table of the dynamic programming is
+    filled for all pairs at once, one year after the other.
+    :param left: numpy.ndarray (n_left, n_years) without NaN
+    :param right: numpy.ndarray (n_right, n_years) without NaN
+    :kwarg window: int maximum shift in years (Sakoe-Chiba band), None for no limit
+    :returns: numpy.ndarray (n_left, n_right)
+    """
+    window = kwargs.get("window", None)
+    n_years = left.shape[1]
+    window = n_years if window is None else window
+
+    previous = np.full((left.shape[0], right.shape[0], n_years + 1), np.inf)
+    previous[:, :, 0] = 0.0
+    for i in range(1, n_years + 1):
+        current = np.full_like(previous, np.inf)
+        cost = np.abs(left[:, None, i - 1, None] - right[None, :, :])
+        for j in range(max(1, i - window), min(n_years, i + window) + 1):
+            best = np.minimum(np.minimum(previous[:, :, j], previous[:, :, j - 1]), current[:, :, j - 1])
+            current[:, :, j] = cost[:, :, j - 1] + best
+        previous = current
+    return previous[:, :, n_years]
+
+
+def pairwise(matrix, metric, **kwargs):
+    """
+    metric between all rows of matrix, optionally in blocks of rows in worker processes
+    :param matrix: numpy.ndarray (n_rows, n_years)
+    :param metric: str "pearson", "spearman", "growth", "euclidean" or "dtw"
+    :kwarg normalize: bool z-score the rows before the distances
+    :kwarg workers: int
+    :kwarg block_size: int rows per block
+    :kwarg window: int dtw window
+    :returns: numpy.ndarray (n_rows, n_rows)
+    """
+    normalize = kwargs.get("normalize", cf.similarity_normalize)
+    workers = kwargs.get("workers", cf.similarity_workers) or os.cpu_count()
+    block_size = kwargs.get("block_size", cf.similarity_block_size)
+    window = kwargs.get("window", None)
+
+    if metric == "growth":
+        matrix = growth_rates(matrix)
+    elif metric in distance_metrics:
+        if normalize:
+            matrix = zscore_rows(matrix)
+        if metric == "dtw":
+            matrix = fill_rows(matrix)
+    elif metric not in ("pearson", "spearman"):
+        raise ValueError(f"unknown metric: {metric}, choose one of {correlation_metrics + distance_metrics}")
+
+    tasks = [(matrix[start:start + block_size], matrix, metric, window)
+             for start in range(0, len(matrix), block_size)]
+    if workers == 1 or len(tasks) == 1:
+        blocks = list(map(_block_task, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            blocks = list(executor.map(_block_task, tasks))
+    if len(blocks) == 0:
+        return np.zeros((0, 0))
+    return np.concatenate(blocks, axis=0)
+
+
+def _block_task(task):
+    """
+    one block of rows against all rows
+    :param task: tuple (block, matrix, metric, window)
+    """
+    block, matrix, metric, window = task
+    if metric == "euclidean":
+        return euclidean(block, matrix)
+    if metric == "dtw":
+        return dtw(block, matrix, window=window)
+    if metric == "spearman":
+        return spearman(block, matrix)
+    return pearson(block, matrix)
+
+
+def matrix_fingerprint(matrix_df, metric, kwargs):
+    """
+    hash of the values, countries, years, metric and its settings
+    :returns: str
+    """
+    sha = hashlib.sha256()
+    sha.update(matrix_df.to_numpy().tobytes())
+    sha.update(repr((similarity_version, list(matrix_df.index), list(matrix_df.columns), metric,
+                     kwargs.get("normalize", cf.similarity_normalize), kwargs.get("window", None))).encode())
+    return sha.hexdigest()[:24]
+
+
+@instrumented
+def similarity_matrix(em_data, gas, metric, **kwargs):
+    """
+    country x country matrix of one gas and metric. With a cache directory the matrix is stored
+    as npz file and reused as long as the values of the gas and the settings are the same.
+    :param em_data: pandas.DataFrame
+    :param gas: str
+    :param metric: str see pairwise
+    :kwarg cache_dir: Windows.Path or None
+    :kwarg normalize, workers, block_size, window: see pairwise
+    :returns matrix_df: pandas.DataFrame
+    """
+    cache_dir = kwargs.get("cache_dir", cf.similarity_cache_dir)
+
+    values_df = country_matrix(em_data, gas)
+    if cache_dir is not None:
+        cache_path = Path(cache_dir).joinpath(f"{gas}_{metric}_{matrix_fingerprint(values_df, metric, kwargs)}.npz")
+        if cache_path.exists():
+            with np.load(cache_path) as cached:
+                return pd.DataFrame(cached["matrix"], index=values_df.index, columns=values_df.index)
+
+    matrix = pairwise(values_df.to_numpy(), metric, **kwargs)
+    if cache_dir is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # np.savez adds .npz to names without it, so the temporary file also ends on .npz
+        temp_path = cache_path.with_name(cache_path.stem + f".{os.getpid()}.tmp.npz")
+        np.savez(temp_path, matrix=matrix)
+        os.replace(temp_path, cache_path)
+    return pd.DataFrame(matrix, index=values_df.index, columns=values_df.index)
+
+
+def similarity_matrices(em_data, gases, metrics, **kwargs):
+    """
+    similarity_matrix of every gas and metric
+    :returns: dict with (gas, metric) as key and a pandas.DataFrame as value
+    """
+    return {(gas, metric): similarity_matrix(em_data, gas, metric, **kwargs)
+            for gas in gases for metric in metrics}
+
+
+def peers(matrix_df, country, **kwargs):
+    """
+    the k most similar countries of country (highest correlation or smallest distance)
+    :param matrix_df: pandas.DataFrame from similarity_matrix
+    :param country: str
+    :kwarg k: int
+    :kwarg metric: str, only needed to know if matrix_df holds distances (default: guessed
+                   from the diagonal, 0 for distances)
+    :returns: pandas.Series
+    """
+    k = kwargs.get("k", 5)
+    metric = kwargs.get("metric", None)
+
+    row = matrix_df.loc[country].drop(country).dropna()
+    if metric is None:
+        is_distance = matrix_df.loc[country, country] == 0
+    else:
+        is_distance = metric in distance_metrics
+    return row.nsmallest(k) if is_distance else row.nlargest(k)
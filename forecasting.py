@@ -0,0 +1,420 @@
+## module:: Data challenge forecasting
+#     :platform:   Windows
+#     :synopsis:   SARIMAX forecasts for all country/gas series
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+import hashlib
+import os
+import warnings
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import Data_preperation as dp
+import config_file as cf
+from instrumentation import instrumented
+
+# environment variables read by the different BLAS/OpenMP implementations
+BLAS_THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+######################################################################
+
+def prepare_series(one_series, **kwargs):
+    """
+    turn an interpolated dataframe of one country and one gas into a time series with the
+    column "y" and a fixed frequency as needed by SARIMAX
+    :param one_series: pandas.DataFrame
+    :kwarg freq: str frequency of the interpolation grid (Data_preperation.interpolation_freq),
+                 None infers it from the time stamps
+    :returns series: pandas.DataFrame
+    """
+    freq = kwargs.get("freq", None)
+
+    series = one_series[["year", "value"]].set_index("year").sort_index()
+    if freq is None and len(series) > 2:
+        freq = pd.infer_freq(series.index)
+    if freq is not None:
+        # the grid already has this frequency, only the index gets it (checked by pandas)
+        series.index = pd.DatetimeIndex(series.index, freq=freq)
+    series = series.rename(columns={"value": "y"})
+    return series
+
+
+@instrumented
+def build_all_series(working_dict, intervall, **kwargs):
+    """
+    interpolate every country/gas combination of the output of seperate_categories
+    :param working_dict: dict
+    :param intervall: int or str
+    :kwarg countries: list only use these countries
+    :kwarg gases: list only use these keys of working_dict
+    :returns series_dict: dict with (country, gas) as key and a pandas.DataFrame as value
+    """
+    countries = kwargs.get("countries", None)
+    gases = kwargs.get("gases", list(working_dict.keys()))
+
+    emission_df = pd.concat([working_dict[gas] for gas in gases], ignore_index=True)
+    if countries is not None:
+        emission_df = emission_df[emission_df["country_or_area"].isin(countries)]
+    interpolated_df = dp.dataframe_interpolation(emission_df, intervall)
+    freq = dp.interpolation_freq(intervall)
+
+    series_dict = {}
+    for (country, gas), one_series in interpolated_df.groupby(["country_or_area", "category"],
+                                                              observed=True, sort=False):
+        series_dict[(country, gas)] = prepare_series(one_series, freq=freq)
+    return series_dict
+
+
+@instrumented
+def build_series(store, keys, intervall):
+    """
+    interpolate only the given country/gas combinations, looked up in an EmissionStore
+    :param store: Data_preperation.EmissionStore
+    :param keys: list of (country, gas)
+    :param intervall: int or str
+    :returns series_dict: dict with (country, gas) as key and a pandas.DataFrame as value
+    """
+    series_dict = {}
+    for key in keys:
+        one_series = store.series(*key)
+        if len(one_series) > 0:
+            series_dict[key] = prepare_series(dp.dataframe_interpolation(one_series, intervall),
+                                              freq=dp.interpolation_freq(intervall))
+    return series_dict
+
+
+@instrumented
+def fit_forecast(series, **kwargs):
+    """
+    fit a SARIMAX model on the first part of the series, backtest it on the rest and forecast
+    the next steps after the training data
+    :param series: pandas.DataFrame with the column "y"
+    :kwarg train_percent: float share of the data used for training
+    :kwarg order: tuple (p, d, q)
+    :kwarg seasonal_order: tuple (P, D, Q, s)
+    :kwarg steps: int number of forecasted steps
+    :kwarg model_cache: Windows.Path directory for fitted models or None
+    :kwarg auto_order: bool search the orders with model_selection.select_order
+    :kwarg search_workers: int worker processes of the order search (default 1)
+    :kwarg alpha: float 1 - confidence of the prediction intervals (columns y_lower, y_upper)
+    :kwarg simulate_paths: int number of simulated paths for the quantile columns (y_q5, ...), 0 for none
+    :returns train, test, backtest_df, forecast_df: pandas.DataFrame
+    """
+    train_percent = kwargs.get("train_percent", cf.train_percent)
+    order = kwargs.get("order", cf.sarimax_order)
+    seasonal_order = kwargs.get("seasonal_order", cf.seasonal_order)
+    steps = kwargs.get("steps", cf.forecast_steps)
+    model_cache = kwargs.get("model_cache", cf.model_cache_dir if cf.use_model_cache else None)
+    auto_order = kwargs.get("auto_order", cf.auto_order)
+    search_workers = kwargs.get("search_workers", 1)
+    alpha = kwargs.get("alpha", cf.forecast_alpha)
+    simulate_paths = kwargs.get("simulate_paths", cf.simulate_paths)
+
+    # without a frequency SARIMAX only knows positions and the backtest dates are not found
+    check_frequency(series.index)
+
+    if auto_order:
+        from model_selection import select_order
+        order, seasonal_order, _ = select_order(series["y"], train_percent=train_percent,
+                                                workers=search_workers)
+
+    split = int(round(len(series)*train_percent, 0))
+    train = series[:split]
+    test = series[split:]
+
+    sarimax_results = fit_sarimax(train["y"], order, seasonal_order, model_cache=model_cache)
+
+    forecast_df = _interval_frame(sarimax_results.get_forecast(steps=steps), alpha)
+    if len(test) > 0:
+        backtest_df = _interval_frame(sarimax_results.get_prediction(start=test.index[0], end=test.index[-1]), alpha)
+        backtest_df.index = test.index
+    else:
+        backtest_df = pd.DataFrame({"y": [], "y_lower": [], "y_upper": []}, index=test.index)
+
+    if simulate_paths > 0:
+        # all paths in one simulation, the quantiles of the first steps also belong to the backtest
+        paths = sarimax_results.simulate(nsimulations=max(steps, len(test)), repetitions=simulate_paths,
+                                         anchor="end")
+        quantiles = path_quantiles(np.asarray(paths).reshape(len(paths), -1).T[None], cf.path_quantiles)
+        forecast_df = forecast_df.assign(**{name: values[0, :steps] for name, values in quantiles.items()})
+        backtest_df = backtest_df.assign(**{name: values[0, :len(test)] for name, values in quantiles.items()})
+
+    return train, test, backtest_df, forecast_df
+
+
+def check_frequency(index):
+    """
+    raise a ValueError if the time stamps of a series have no fixed frequency, so no forecast
+    dates can be generated (interpolation intervals, which do not divide 12)
+    :param index: pandas.DatetimeIndex
+    """
+    if getattr(index, "freq", None) is None:
+        raise ValueError("the series has no fixed frequency, use an interpolation_intervall that divides "
+                         "12 (1, 2, 3, 4, 6 or 12) or a pandas frequency string")
+
+
+def _interval_frame(prediction_results, alpha):
+    """
+    mean and prediction interval of statsmodels PredictionResults
+    :returns: pandas.DataFrame with the columns y, y_lower, y_upper
+    """
+    interval = np.asarray(prediction_results.conf_int(alpha=alpha))
+    return pd.DataFrame({"y": prediction_results.predicted_mean, "y_lower": interval[:, 0],
+                         "y_upper": interval[:, 1]})
+
+
+def path_quantiles(paths, quantiles):
+    """
+    quantiles of simulated paths
+    :param paths: numpy.ndarray (n_series, n_paths, steps)
+    :param quantiles: list of float
+    :returns: dict column name (y_q5 for 0.05) -> numpy.ndarray (n_series, steps)
+    """
+    values = np.quantile(paths, quantiles, axis=1)
+    return {"y_q" + f"{quantile*100:g}": value for quantile, value in zip(quantiles, values)}
+
+
+def fit_sarimax(y, order, seasonal_order, **kwargs):
+    """
+    fit a SARIMAX model. With a model_cache directory the fitted results are stored there and
+    reloaded instead of refitting, as long as series, orders and statsmodels version are the same.
+    :param y: pandas.Series
+    :param order: tuple (p, d, q)
+    :param seasonal_order: tuple (P, D, Q, s)
+    :kwarg model_cache: Windows.Path directory of the stored models or None
+    :kwarg max_cache_size: int maximum size of model_cache in bytes
+    :returns sarimax_results: SARIMAXResults
+    """
+    from statsmodels.tsa.statespace.sarimax import SARIMAX, SARIMAXResults
+
+    model_cache = kwargs.get("model_cache", None)
+    max_cache_size = kwargs.get("max_cache_size", cf.model_cache_size)
+
+    if model_cache is not None:
+        model_path = Path(model_cache).joinpath(model_fingerprint(y, order, seasonal_order) + ".pickle")
+        if model_path.exists():
+            try:
+                sarimax_results = SARIMAXResults.load(model_path)
+            except Exception:
+                # broken or incompatible file, fit again and overwrite it
+                pass
+            else:
+                # update the modification time, it is used for the least recently used eviction
+                os.utime(model_path)
+                return sarimax_results
+
+    model = SARIMAX(
+        y,
+        order=order,
+        seasonal_order=seasonal_order,
+        enforce_stationarity=False,
+        enforce_invertibility=False
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        sarimax_results = model.fit(disp=False)
+
+    if model_cache is not None:
+        model_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, other worker processes may read the same model
+        temp_path = model_path.with_suffix(f".{os.getpid()}.tmp")
+        sarimax_results.save(temp_path)
+        os.replace(temp_path, model_path)
+        evict_models(model_cache, max_cache_size)
+    return sarimax_results
+
+
+def model_fingerprint(y, order, seasonal_order):
+    """
+    hash of everything a fitted SARIMAX model depends on: values and index of the training
+    series, the model orders and the statsmodels version
+    :param y: pandas.Series
+    :param order: tuple (p, d, q)
+    :param seasonal_order: tuple (P, D, Q, s)
+    :returns: str
+    """
+    import statsmodels
+
+    sha = hashlib.sha256()
+    sha.update(y.to_numpy(dtype="float64").tobytes())
+    sha.update(y.index.asi8.tobytes() if hasattr(y.index, "asi8") else repr(list(y.index)).encode())
+    sha.update(str(getattr(y.index, "freqstr", None)).encode())
+    sha.update(repr((tuple(order), tuple(seasonal_order), statsmodels.__version__)).encode())
+    return sha.hexdigest()
+
+
+def evict_models(model_cache, max_cache_size):
+    """
+    delete the least recently used models until model_cache is smaller than max_cache_size
+    :param model_cache: Windows.Path
+    :param max_cache_size: int bytes
+    """
+    models = []
+    for model_path in Path(model_cache).glob("*.pickle"):
+        try:
+            stat = model_path.stat()
+        except FileNotFoundError:
+            continue
+        models.append((stat.st_mtime, stat.st_size, model_path))
+
+    cache_size = sum(size for _, size, _ in models)
+    for _, size, model_path in sorted(models):
+        if cache_size <= max_cache_size:
+            break
+        model_path.unlink(missing_ok=True)
+        cache_size -= size
+
+
+def _forecast_task(task):
+    """
+    forecast one series inside a worker process
+    :param task: tuple (key, series, kwargs)
+    :returns key, table or error message
+    """
+    key, series, kwargs = task
+    try:
+        parts = fit_forecast(series, **kwargs)
+    except Exception as error:
+        return key, None, f"{type(error).__name__}: {error}"
+
+    table = pd.concat([part.assign(type=name) for part, name in
+                       zip(parts, ["train", "test", "backtest", "forecast"])])
+    table.index.name = "year"
+    return key, table.reset_index(), None
+
+
+def _restore_environment(old_environment):
+    """
+    set the environment variables back to the old values, remove the ones which did not exist
+    :param old_environment: dict variable -> str or None
+    """
+    for variable, value in old_environment.items():
+        if value is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = value
+
+
+def _limit_blas_threads(n_threads):
+    """
+    initializer of the worker processes: limit the BLAS threads so the workers do not
+    oversubscribe the cores
+    :param n_threads: int
+    """
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads)
+
+
+def batch_forecast(working_dict, **kwargs):
+    """
+    interpolate, fit, backtest and forecast every country/gas series of working_dict (output of
+    seperate_categories) in a process pool and collect the results in one table with the
+    columns country_or_area, category, year, y and type (train, test, backtest or forecast)
+
+    :param working_dict: dict
+    :kwarg intervall: int or str interpolation intervall
+    :kwarg countries: list only use these countries
+    :kwarg workers: int number of worker processes, 1 runs everything in this process
+    :kwarg blas_threads: int BLAS threads per worker
+    :kwarg train_percent, order, seasonal_order, steps, auto_order: passed on to fit_forecast
+    :returns forecast_table: pandas.DataFrame
+    """
+    intervall = kwargs.pop("intervall", cf.interpolation_intervall)
+    countries = kwargs.pop("countries", None)
+
+    series_dict = build_all_series(working_dict, intervall, countries=countries)
+    return forecast_series(series_dict, **kwargs)
+
+
+@instrumented
+def forecast_series(series_dict, **kwargs):
+    """
+    fit, backtest and forecast every series of series_dict (output of build_all_series) in a
+    process pool and collect the results in one table like batch_forecast
+
+    :param series_dict: dict with (country, gas) as key and a pandas.DataFrame as value
+    :kwarg engine: str "sarimax" (one model per series) or "vectorized" (all ARIMA(p, d, 0) models
+                   at once, see vector_arima)
+    :kwarg workers: int number of worker processes, 1 runs everything in this process
+    :kwarg blas_threads: int BLAS threads per worker
+    :kwarg train_percent, order, seasonal_order, steps, auto_order: passed on to fit_forecast
+    :kwarg alpha, simulate_paths: intervals and simulated quantiles, passed on to fit_forecast
+    :returns forecast_table: pandas.DataFrame with the intervals of the backtest and forecast rows
+    """
+    engine = kwargs.pop("engine", cf.forecast_engine)
+    workers = kwargs.pop("workers", cf.forecast_workers) or os.cpu_count()
+    blas_threads = kwargs.pop("blas_threads", cf.blas_threads)
+
+    if engine == "vectorized":
+        import vector_arima as va
+        if kwargs.get("auto_order", cf.auto_order):
+            raise ValueError("the vectorized engine does not search the orders, set auto_order to False")
+        return va.forecast_series_vectorized(series_dict, **kwargs)
+    elif engine != "sarimax":
+        raise ValueError(f"unknown engine: {engine}")
+    # fail once before starting the pool instead of once per series
+    for series in series_dict.values():
+        check_frequency(series.index)
+
+    tasks = [(key, series, kwargs) for key, series in series_dict.items()]
+
+    if workers == 1:
+        results = map(_forecast_task, tasks)
+    else:
+        # set the variables here as well, spawned workers read them on import of numpy. They are
+        # restored after the pool is shut down, so later processes of this session are not limited
+        old_environment = {variable: os.environ.get(variable) for variable in BLAS_THREAD_VARIABLES}
+        for variable in BLAS_THREAD_VARIABLES:
+            os.environ.setdefault(variable, str(blas_threads))
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_limit_blas_threads,
+                                       initargs=(blas_threads,))
+        chunksize = max(1, len(tasks) // (workers*4))
+        results = executor.map(_forecast_task, tasks, chunksize=chunksize)
+
+    tables = []
+    try:
+        for (country, gas), table, error in results:
+            if error is not None:
+                print(f"forecast of {gas} for {country} failed: {error}")
+                continue
+            tables.append(table.assign(country_or_area=country, category=gas))
+    finally:
+        if workers != 1:
+            executor.shutdown()
+            _restore_environment(old_environment)
+
+    columns = ["country_or_area", "category", "year", "y", "type"]
+    if len(tables) == 0:
+        return pd.DataFrame(columns=columns)
+    forecast_table = pd.concat(tables, ignore_index=True)
+    # intervals and quantiles of the backtest and forecast rows
+    interval_columns = [column for column in forecast_table.columns if column.startswith("y_")]
+    return forecast_table[columns[:4] + interval_columns + columns[4:]]
+
+
+def save_forecast_table(forecast_table, **kwargs):
+    """
+    write the forecast table with its intervals as csv and/or parquet (columnar, needs pyarrow)
+    :param forecast_table: pandas.DataFrame
+    :kwarg forecast_name: str file name without suffix
+    :kwarg formats: list of "csv", "parquet" (needs pyarrow)
+    """
+    forecast_name = kwargs.get("forecast_name", cf.save_forecast_name)
+    formats = kwargs.get("formats", cf.forecast_formats)
+
+    if "csv" in formats:
+        forecast_table.to_csv(forecast_name + ".csv", index=False)
+    if "parquet" in formats:
+        forecast_table.astype({"country_or_area": "category", "category": "category",
+                               "type": "category"}).to_parquet(forecast_name + ".parquet", index=False)
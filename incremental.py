@@ -0,0 +1,194 @@
+## module:: Data challenge incremental results
+#     :platform:   Windows
+#     :synopsis:   update the analysis results with new rows instead of recalculating them
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import Data_preperation as dp
+import config_file as cf
+
+######################################################################
+
+class ResultStore:
+    """
+    running aggregates for calc_Results: sum, maximum and the value of the earliest year of every
+    category/country series and the k largest and smallest rows of every category. update only
+    touches the new rows, results_dict gives the same dictionary as calc_Results on all rows seen
+    so far (appended in the order of the updates), also if an update adds older years. Rows are
+    only appended, changed values of already seen years are not detected.
+
+    :param categories: list of short category labels
+    :kwarg countries: list countries of the total and most-improved rankings, None uses all
+                      countries seen in any row (like calc_Results with the countries of the data)
+    :kwarg k: int length of the rankings
+    :kwarg years: tuple (first year, last year) only use these years, None for all
+    """
+
+    # stores of an older version are built again (apply_delta)
+    version = 2
+
+    def __init__(self, categories, **kwargs):
+        self.categories = list(categories)
+        self.countries = kwargs.get("countries", None)
+        self.version = ResultStore.version
+        self.k = kwargs.get("k", 3)
+        self.years = kwargs.get("years", None)
+
+        self.totals = {}
+        self.maxima = {}
+        self.firsts = {}
+        self.first_years = {}
+        # all countries in the order they were seen, also the ones without rows of the categories
+        self.seen_countries = {}
+        self.largest_rows = {}
+        self.smallest_rows = {}
+        self.n_rows = 0
+        self.applied_files = set()
+
+    def update(self, em_data):
+        """
+        add new rows (raw or prepared emission data with short category labels)
+        :param em_data: pandas.DataFrame
+        """
+        # row labels continue after the rows seen before, like the index of the concatenated data
+        em_data = em_data.set_axis(pd.RangeIndex(self.n_rows, self.n_rows + len(em_data)))
+        self.n_rows += len(em_data)
+        self.seen_countries.update(dict.fromkeys(str(country) for country in em_data["country_or_area"].unique()))
+        em_data = em_data[em_data["category"].isin(self.categories)]
+        if self.years is not None:
+            first_year, last_year = self.years
+            year = em_data["year"] if em_data["year"].dtype.kind in "iu" else dp.year_dates(em_data).dt.year
+            em_data = em_data[year.between(first_year if first_year is not None else -np.inf,
+                                           last_year if last_year is not None else np.inf)]
+        em_data = em_data.assign(year=dp.year_dates(em_data)).drop(columns="date", errors="ignore")
+
+        grouped = em_data.groupby(["category", "country_or_area"], observed=True, sort=False)
+        aggregated = grouped["value"].agg(["sum", "max"])
+        earliest = grouped["year"].idxmin().to_numpy()
+        aggregated["first_year"] = em_data.loc[earliest, "year"].to_numpy()
+        aggregated["first"] = em_data.loc[earliest, "value"].to_numpy()
+        for key, total, maximum, first_year, first in zip(aggregated.index, aggregated["sum"], aggregated["max"],
+                                                          aggregated["first_year"], aggregated["first"]):
+            self.totals[key] = self.totals.get(key, 0) + total
+            self.maxima[key] = np.fmax(self.maxima.get(key, np.nan), maximum)
+            # an update with older years replaces the value of the earliest year
+            if key not in self.first_years or first_year < self.first_years[key]:
+                self.first_years[key] = first_year
+                self.firsts[key] = first
+
+        for gas, one_gas in em_data.groupby("category", observed=True, sort=False):
+            self.largest_rows[gas] = pd.concat([self.largest_rows.get(gas), one_gas.nlargest(self.k, "value")])\
+                                       .nlargest(self.k, "value")
+            self.smallest_rows[gas] = pd.concat([self.smallest_rows.get(gas), one_gas.nsmallest(self.k, "value")])\
+                                        .nsmallest(self.k, "value")
+
+    def update_csv(self, delta_path):
+        """
+        add the rows of a csv file, a file with the same content is only added once
+        :param delta_path: Windows.Path
+        :returns: bool True if the file was added
+        """
+        content_hash = dp.file_hash(delta_path)
+        if content_hash in self.applied_files:
+            return False
+        self.update(dp.prepare_emission_data(dp.load_csv_data(delta_path)))
+        self.applied_files.add(content_hash)
+        return True
+
+    def results_dict(self):
+        """
+        the results of all rows seen so far, same shape as calc_Results
+        :returns results_dict: dict
+        """
+        results_dict = {"max-year": {}, "min-year": {}, "max-total": {}, "min-total": {}, "most-improved": {}}
+        for gas in self.categories:
+            results_dict["max-year"][gas] = round(self.largest_rows.get(gas, pd.DataFrame()), 1)
+            results_dict["min-year"][gas] = round(self.smallest_rows.get(gas, pd.DataFrame()), 1)
+
+            countries = self.countries
+            if countries is None:
+                countries = list(self.seen_countries)
+            totals = pd.Series([self.totals.get((gas, country), 0) for country in countries],
+                               index=[gas + "_" + country for country in countries], dtype=float)
+            # sorted before rounding like calc_Results
+            results_dict["max-total"][gas] = \
+                round(totals.add_prefix("max_total_").sort_values(ascending=False, kind="stable"), 1)[:self.k]
+            results_dict["min-total"][gas] = \
+                round(totals.add_prefix("min_total_").sort_values(ascending=True, kind="stable"), 1)[:self.k]
+
+            seen = [country for country in countries if (gas, country) in self.firsts]
+            improved = pd.Series([self.maxima[(gas, country)] / self.firsts[(gas, country)] for country in seen],
+                                 index=["most-improved_" + gas + "_" + country for country in seen], dtype=float)
+            improved = improved.sort_values(ascending=False, kind="stable")
+            results_dict["most-improved"][gas] = round(improved, 2)[:self.k]
+        return results_dict
+
+    def save(self, store_path):
+        """
+        :param store_path: Windows.Path pickle file
+        """
+        Path(store_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(store_path, "wb") as file:
+            pickle.dump(self, file)
+
+    @staticmethod
+    def load(store_path):
+        """
+        :param store_path: Windows.Path pickle file
+        :returns: ResultStore
+        """
+        with open(store_path, "rb") as file:
+            return pickle.load(file)
+
+
+def apply_delta(delta_path, **kwargs):
+    """
+    add the rows of delta_path to the stored results and export the updated results
+    (Data_preperation.export_results) as results_name. Without a stored ResultStore it is first
+    built from the complete data file. The rankings of ranking_metrics need all rows of a series
+    and are only exported by the analyze stage, so the default results_name is not the one of
+    the analyze stage.
+
+    :param delta_path: Windows.Path csv file with the new rows
+    :kwarg store_path: Windows.Path pickle file of the ResultStore
+    :kwarg data_path: Windows.Path complete data for the first ResultStore
+    :kwarg gases: list
+    :kwarg k: int length of the rankings
+    :kwarg years: tuple (first year, last year) only use these years, None for all
+    :kwarg countries: list countries of the rankings, None for all countries of the data
+    :kwarg results_name: str file name without suffix
+    :returns results_dict: dict
+    """
+    store_path = Path(kwargs.get("store_path", cf.result_store_path))
+    data_path = kwargs.get("data_path", cf.emission_data_path)
+    gases = kwargs.get("gases", cf.interesting_gases)
+    k = kwargs.get("k", cf.ranking_k)
+    years = kwargs.get("years", cf.ranking_years)
+    countries = kwargs.get("countries", None)
+    results_name = kwargs.get("results_name", cf.save_results_name + "_incremental")
+
+    if store_path.exists():
+        result_store = ResultStore.load(store_path)
+        stored = (result_store.categories, result_store.k, getattr(result_store, "years", None))
+        if stored != (list(gases), k, years) or getattr(result_store, "version", 1) != ResultStore.version:
+            # the running aggregates can not be changed afterwards, the added rows are not kept
+            raise ValueError(f"{store_path} was built with other gases, k or years {stored} or by an older "
+                             "version, delete it to build it again from the complete data")
+    else:
+        result_store = ResultStore(gases, k=k, years=years, countries=countries)
+        result_store.update(dp.prepare_emission_data(dp.load_csv_data(data_path)))
+
+    if not result_store.update_csv(delta_path):
+        print(f"{delta_path} was already added")
+    result_store.save(store_path)
+
+    results_dict = result_store.results_dict()
+    dp.export_results(results_dict, results_name=results_name)
+    return results_dict
@@ -0,0 +1,219 @@
+## module:: Data challenge instrumentation
+#     :platform:   Windows
+#     :synopsis:   time, memory and row counts of the pipeline functions and stages
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+import config_file as cf
+
+# finished measurements (dicts) of this process in the order they ended. Functions running in the
+# worker processes of a pool record into the copy of this list in the worker, which is not exported:
+# for pooled steps only the time and memory of the calling process are in the traces
+records = []
+_start = time.perf_counter()
+# highest tracemalloc peak of every open measurement before its last nested measurement
+# started, tracemalloc only has one global peak
+_peak_stack = []
+
+######################################################################
+
+def enabled():
+    return cf.instrumentation == True
+
+
+def rss_mb():
+    """
+    current resident memory of the process
+    :returns: float MB
+    """
+    import psutil
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+def peak_rss_mb():
+    """
+    peak resident memory over the whole lifetime of the process (not of one measurement,
+    see rss_delta_mb of the records for that)
+    :returns: float MB
+    """
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024**2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def count_rows(data):
+    """
+    rows of a dataframe/series, of all dataframes in a dict or tuple, else None
+    """
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return len(data)
+    if isinstance(data, dict):
+        data = list(data.values())
+    if isinstance(data, (list, tuple)):
+        rows = [count_rows(value) for value in data]
+        rows = [row for row in rows if row is not None]
+        return sum(rows) if len(rows) > 0 else None
+    return None
+
+
+@contextmanager
+def measure(name, **kwargs):
+    """
+    record wall time, cpu time, memory and rows of the code block. The memory is the change of
+    the resident memory over the block (rss_delta_mb) and the lifetime peak of the process
+    (peak_rss_mb). The yielded dict can be filled with more values (e.g. record["rows_out"]).
+    Does nothing if instrumentation in config_file is False.
+    :param name: str
+    :kwarg rows: int rows of the input
+    :kwarg category: str "function" or "stage"
+    :kwarg profile: bool profile the block, if name is profile_stage in config_file
+    """
+    record = {"name": name, "category": kwargs.get("category", "function"), "rows": kwargs.get("rows", None)}
+    if not enabled():
+        yield record
+        return
+
+    trace_memory = cf.trace_memory == True
+    if trace_memory:
+        stop_tracing = not tracemalloc.is_tracing()
+        if stop_tracing:
+            tracemalloc.start()
+        elif len(_peak_stack) > 0:
+            _peak_stack[-1] = max(_peak_stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        _peak_stack.append(0)
+    profiler = _start_profiler(name) if kwargs.get("profile", False) and cf.profile_stage == name else None
+
+    rss_start = rss_mb()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - start
+        record["cpu_s"] = time.process_time() - cpu_start
+        record["start_s"] = start - _start
+        record["rss_mb"] = rss_mb()
+        record["rss_delta_mb"] = record["rss_mb"] - rss_start
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["pid"] = os.getpid()
+        record["thread"] = threading.get_ident()
+        if profiler is not None:
+            record["profile"] = _stop_profiler(profiler, name)
+        if trace_memory:
+            peak = max(_peak_stack.pop(), tracemalloc.get_traced_memory()[1])
+            record["peak_traced_mb"] = peak / 1024**2
+            if len(_peak_stack) > 0:
+                _peak_stack[-1] = max(_peak_stack[-1], peak)
+            if stop_tracing:
+                tracemalloc.stop()
+        records.append(record)
+
+
+def instrumented(function):
+    """
+    decorator: measure every call of function, rows are the rows of the first dataframe argument,
+    rows_out the rows of the result
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return function(*args, **kwargs)
+        rows = next((count_rows(arg) for arg in args if count_rows(arg) is not None), None)
+        with measure(function.__module__ + "." + function.__qualname__, rows=rows) as record:
+            result = function(*args, **kwargs)
+            record["rows_out"] = count_rows(result)
+        return result
+    return wrapper
+
+
+def _start_profiler(name):
+    if cf.profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, name):
+    """
+    stop the profiler and write its output into trace_dir
+    :returns: str path of the profile
+    """
+    Path(cf.trace_dir).mkdir(parents=True, exist_ok=True)
+    if cf.profiler == "pyinstrument":
+        profiler.stop()
+        profile_path = Path(cf.trace_dir).joinpath("profile_" + name + ".html")
+        profile_path.write_text(profiler.output_html())
+    else:
+        profiler.disable()
+        profile_path = Path(cf.trace_dir).joinpath("profile_" + name + ".prof")
+        profiler.dump_stats(profile_path)
+    return str(profile_path)
+
+
+def export_jsonl(jsonl_path):
+    """
+    append the records as json lines
+    :param jsonl_path: Windows.Path
+    """
+    Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(jsonl_path, "a") as file:
+        for record in records:
+            file.write(json.dumps(record, default=str) + "\n")
+
+
+def export_chrome_trace(trace_path):
+    """
+    write the records in the chrome trace event format (chrome://tracing, perfetto.dev)
+    :param trace_path: Windows.Path
+    """
+    events = []
+    for record in records:
+        args = {key: value for key, value in record.items()
+                if key not in ("name", "category", "start_s", "wall_s", "pid", "thread")}
+        events.append({"name": record["name"], "cat": record["category"], "ph": "X",
+                       "ts": record["start_s"] * 1e6, "dur": record["wall_s"] * 1e6,
+                       "pid": record["pid"], "tid": record["thread"], "args": args})
+    Path(trace_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(trace_path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file, default=str)
+
+
+def write_traces(**kwargs):
+    """
+    export the records of this run as trace_<date>.jsonl and trace_<date>.json (chrome) into trace_dir
+    and clear them
+    :kwarg trace_dir: Windows.Path
+    """
+    trace_dir = Path(kwargs.get("trace_dir", cf.trace_dir))
+    if len(records) == 0:
+        return None
+    export_jsonl(trace_dir.joinpath("trace_" + cf.current_date + ".jsonl"))
+    export_chrome_trace(trace_dir.joinpath("trace_" + cf.current_date + ".json"))
+    records.clear()
+    return trace_dir
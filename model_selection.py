@@ -0,0 +1,199 @@
+## module:: Data challenge model selection
+#     :platform:   Windows
+#     :synopsis:   search of the SARIMAX orders (grid or stepwise)
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+import itertools
+import math
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import config_file as cf
+
+CRITERIA = ["aic", "bic", "mae", "rmse"]
+
+######################################################################
+
+def evaluate_order(y, order, seasonal_order, **kwargs):
+    """
+    fit one SARIMAX candidate on the training part of y and score it. Fits which fail, do not
+    converge within maxiter iterations or give no finite score get the score inf.
+    :param y: pandas.Series
+    :param order: tuple (p, d, q)
+    :param seasonal_order: tuple (P, D, Q, s)
+    :kwarg criterion: str "aic", "bic" (of the fit) or "mae", "rmse" (backtest on the test part)
+    :kwarg train_percent: float
+    :kwarg maxiter: int maximum iterations of the optimizer
+    :returns score: float
+    """
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+    criterion = kwargs.get("criterion", cf.order_criterion)
+    train_percent = kwargs.get("train_percent", cf.train_percent)
+    maxiter = kwargs.get("maxiter", cf.order_search_maxiter)
+
+    split = int(round(len(y)*train_percent, 0))
+    train = y[:split]
+    test = y[split:]
+
+    try:
+        model = SARIMAX(train, order=order, seasonal_order=seasonal_order,
+                        enforce_stationarity=False, enforce_invertibility=False)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            results = model.fit(disp=False, maxiter=maxiter)
+    except Exception:
+        return math.inf
+    if not results.mle_retvals.get("converged", True):
+        return math.inf
+
+    if criterion == "aic":
+        score = results.aic
+    elif criterion == "bic":
+        score = results.bic
+    elif criterion in ["mae", "rmse"]:
+        if len(test) == 0:
+            raise ValueError("backtest criterion needs a test part, train_percent is too big")
+        errors = results.forecast(steps=len(test)).to_numpy() - test.to_numpy()
+        if criterion == "mae":
+            score = np.mean(np.abs(errors))
+        else:
+            score = np.sqrt(np.mean(errors**2))
+    else:
+        raise ValueError(f"unknown criterion: {criterion}, choose one of {CRITERIA}")
+
+    if not np.isfinite(score):
+        return math.inf
+    return float(score)
+
+
+def _evaluate_task(task):
+    """
+    evaluate one candidate inside a worker process
+    :param task: tuple (y, candidate, kwargs)
+    :returns candidate, score
+    """
+    y, (order, seasonal_order), kwargs = task
+    return (order, seasonal_order), evaluate_order(y, order, seasonal_order, **kwargs)
+
+
+def _evaluate(y, candidates, scores, executor, kwargs):
+    """
+    score all candidates, which are not yet in scores
+    :param y: pandas.Series
+    :param candidates: list of (order, seasonal_order)
+    :param scores: dict, updated in place
+    :param executor: concurrent.futures.Executor or None
+    :param kwargs: dict passed on to evaluate_order
+    """
+    tasks = [(y, candidate, kwargs) for candidate in dict.fromkeys(candidates) if candidate not in scores]
+    if executor is None:
+        results = map(_evaluate_task, tasks)
+    else:
+        results = executor.map(_evaluate_task, tasks)
+    for candidate, score in results:
+        scores[candidate] = score
+
+
+def _grid_candidates(max_order, max_seasonal_order):
+    """
+    all combinations of orders up to max_order and max_seasonal_order
+    :param max_order: tuple (p, d, q)
+    :param max_seasonal_order: tuple (P, D, Q, s)
+    :returns: list of (order, seasonal_order)
+    """
+    period = max_seasonal_order[3]
+    orders = itertools.product(*[range(limit + 1) for limit in max_order])
+    if period > 1:
+        seasonal_orders = [seasonal + (period,) for seasonal in
+                           itertools.product(*[range(limit + 1) for limit in max_seasonal_order[:3]])]
+    else:
+        seasonal_orders = [(0, 0, 0, 0)]
+    return list(itertools.product(orders, seasonal_orders))
+
+
+def _neighbours(candidate, max_order, max_seasonal_order):
+    """
+    all candidates, which differ by one in one of the orders (stepwise search)
+    :param candidate: (order, seasonal_order)
+    :param max_order: tuple (p, d, q)
+    :param max_seasonal_order: tuple (P, D, Q, s)
+    :returns: list of (order, seasonal_order)
+    """
+    order, seasonal_order = candidate
+    period = max_seasonal_order[3]
+    values = list(order) + (list(seasonal_order[:3]) if period > 1 else [])
+    limits = list(max_order) + list(max_seasonal_order[:3])
+
+    neighbours = []
+    for position in range(len(values)):
+        for step in [-1, 1]:
+            changed = list(values)
+            changed[position] += step
+            if 0 <= changed[position] <= limits[position]:
+                if period > 1:
+                    neighbours.append((tuple(changed[:3]), tuple(changed[3:]) + (period,)))
+                else:
+                    neighbours.append((tuple(changed), (0, 0, 0, 0)))
+    return neighbours
+
+
+def select_order(y, **kwargs):
+    """
+    search the best SARIMAX orders for one series. "grid" scores every combination up to the
+    maximum orders, "stepwise" starts with a few simple models and only moves to the neighbours
+    (one order changed by one) of the best model, until no neighbour is better.
+    The candidates of one step are fitted in a process pool.
+
+    :param y: pandas.Series
+    :kwarg search: str "stepwise" or "grid"
+    :kwarg criterion: str "aic", "bic", "mae" or "rmse"
+    :kwarg max_order: tuple maximum (p, d, q)
+    :kwarg max_seasonal_order: tuple maximum (P, D, Q) and the period s, s <= 1 for no seasonality
+    :kwarg workers: int number of worker processes, 1 fits in this process
+    :kwarg train_percent, maxiter: passed on to evaluate_order
+    :returns order, seasonal_order, scores: best orders and the scores of all fitted candidates
+    """
+    search = kwargs.pop("search", cf.order_search)
+    max_order = kwargs.pop("max_order", cf.max_order)
+    max_seasonal_order = kwargs.pop("max_seasonal_order", cf.max_seasonal_order)
+    workers = kwargs.pop("workers", cf.forecast_workers) or os.cpu_count()
+
+    scores = {}
+    executor = None if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+    try:
+        if search == "grid":
+            _evaluate(y, _grid_candidates(max_order, max_seasonal_order), scores, executor, kwargs)
+        elif search == "stepwise":
+            period = max_seasonal_order[3]
+            d = min(1, max_order[1])
+            seasonal = (min(1, max_seasonal_order[0]), 0, min(1, max_seasonal_order[2]), period) \
+                if period > 1 else (0, 0, 0, 0)
+            no_seasonal = (0, 0, 0, period) if period > 1 else (0, 0, 0, 0)
+            start = [((min(2, max_order[0]), d, min(2, max_order[2])), seasonal),
+                     ((0, d, 0), no_seasonal),
+                     ((min(1, max_order[0]), d, 0), seasonal),
+                     ((0, d, min(1, max_order[2])), seasonal)]
+            _evaluate(y, start, scores, executor, kwargs)
+            best = min(scores, key=scores.get)
+            while True:
+                _evaluate(y, _neighbours(best, max_order, max_seasonal_order), scores, executor, kwargs)
+                new_best = min(scores, key=scores.get)
+                if scores[new_best] >= scores[best]:
+                    break
+                best = new_best
+        else:
+            raise ValueError(f"unknown search: {search}, choose stepwise or grid")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    best = min(scores, key=scores.get)
+    if math.isinf(scores[best]):
+        raise RuntimeError("no SARIMAX candidate could be fitted")
+    return best[0], best[1], scores
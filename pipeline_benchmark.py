@@ -0,0 +1,226 @@
+## module:: Data challenge benchmarks
+#     :platform:   Windows
+#     :synopsis:   synthetic data and timing/memory benchmarks of the data pipeline
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+python pipeline_benchmark.py --countries 430 --years 25             run all benchmarks
+python pipeline_benchmark.py --scale 10 --save-baseline base.json   store the numbers as baseline
+python pipeline_benchmark.py --scale 10 --compare base.json         compare against a baseline
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import Data_preperation as dp
+import config_file as cf
+
+# the ten categories of the UN greenhouse gas inventory
+long_categories = [
+    "carbon_dioxide_co2_emissions_without_land_use_land_use_change_and_forestry_lulucf_in_kilotonne_co2_equivalent",
+    "greenhouse_gas_ghgs_emissions_including_indirect_co2_without_lulucf_in_kilotonne_co2_equivalent",
+    "greenhouse_gas_ghgs_emissions_without_land_use_land_use_change_and_forestry_lulucf_in_kilotonne_co2_equivalent",
+    "hydrofluorocarbons_hfcs_emissions_in_kilotonne_co2_equivalent",
+    "methane_ch4_emissions_without_land_use_land_use_change_and_forestry_lulucf_in_kilotonne_co2_equivalent",
+    "nitrogen_trifluoride_nf3_emissions_in_kilotonne_co2_equivalent",
+    "nitrous_oxide_n2o_emissions_without_land_use_land_use_change_and_forestry_lulucf_in_kilotonne_co2_equivalent",
+    "perfluorocarbons_pfcs_emissions_in_kilotonne_co2_equivalent",
+    "sulphur_hexafluoride_sf6_emissions_in_kilotonne_co2_equivalent",
+    "unspecified_mix_of_hydrofluorocarbons_hfcs_and_perfluorocarbons_pfcs_emissions_in_kilotonne_co2_equivalent",
+]
+
+######################################################################
+
+def make_synthetic_data(n_countries=43, n_gases=10, n_years=25, **kwargs):
+    """
+    emission data shaped like Greenhouse.csv: columns country_or_area, year, value, category,
+    years in descending order per country and category. The first country is the European Union.
+    :param n_countries: int
+    :param n_gases: int at most 10
+    :param n_years: int
+    :kwarg seed: int
+    :returns emission_df: pandas.DataFrame
+    """
+    seed = kwargs.get("seed", 0)
+    rng = np.random.default_rng(seed)
+    countries = ["European Union"] + [f"Country {i}" for i in range(1, n_countries)]
+    categories = long_categories[:n_gases]
+    years = np.arange(1990 + n_years - 1, 1989, -1)
+
+    n_series = n_gases * n_countries
+    level = rng.uniform(1, 1e5, size=n_series)
+    trend = rng.normal(0, 0.02, size=n_series)
+    steps = np.arange(n_years)[::-1]
+    values = level[:, None] * (1 + trend[:, None] * steps) + rng.normal(0, 1, (n_series, n_years)) * level[:, None] * 0.02
+
+    return pd.DataFrame({
+        "country_or_area": np.tile(np.repeat(countries, n_years), n_gases),
+        "year": np.tile(years, n_series).astype(str),
+        "value": np.round(np.abs(values.ravel()), 3),
+        "category": np.repeat(categories, n_countries * n_years),
+    })
+
+
+def measure(function, *args, **kwargs):
+    """
+    run function once with tracemalloc for the peak memory and repeat times for the wall time
+    :param function: callable
+    :kwarg repeat: int
+    :returns result, seconds (best run), peak_mb
+    """
+    repeat = kwargs.pop("repeat", 3)
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    peak_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+    return result, min(seconds), peak_mb
+
+
+@contextmanager
+def isolated_outputs(output_dir):
+    """
+    run in output_dir with all caches there and no result database, so the benchmarks do not
+    overwrite the results, caches or database of real runs. Restores the settings afterwards.
+    :param output_dir: Windows.Path
+    """
+    output_dir = Path(output_dir)
+    overrides = {
+        "cache_dir": output_dir.joinpath("Cache"),
+        "stage_cache_dir": output_dir.joinpath("Cache/stages"),
+        "model_cache_dir": output_dir.joinpath("Cache/models"),
+        "similarity_cache_dir": output_dir.joinpath("Cache/similarity"),
+        "result_store_path": output_dir.joinpath("Cache/result_store.pickle"),
+        "trace_dir": output_dir.joinpath("Results/traces"),
+        "result_database": None,
+    }
+    old_settings = {name: getattr(cf, name) for name in overrides}
+    old_cwd = os.getcwd()
+    for name, value in overrides.items():
+        setattr(cf, name, value)
+    # the results and forecasts are written relative to the working directory
+    os.chdir(output_dir)
+    try:
+        yield output_dir
+    finally:
+        os.chdir(old_cwd)
+        for name, value in old_settings.items():
+            setattr(cf, name, value)
+
+
+def run_benchmarks(csv_path, **kwargs):
+    """
+    benchmark the single functions and the pipeline end to end. The end to end run exports its
+    results, run it inside isolated_outputs (as main does).
+    :param csv_path: Windows.Path synthetic data
+    :kwarg repeat: int
+    :kwarg forecast_series: int number of series for the SARIMAX benchmark
+    :returns benchmarks: dict name -> {"seconds", "peak_mb", "rows"}
+    """
+    import forecasting as fc
+    import Greenhouse as gh
+
+    repeat = kwargs.get("repeat", 3)
+    forecast_series = kwargs.get("forecast_series", 5)
+    benchmarks = {}
+
+    def record(name, rows, function, *args, **function_kwargs):
+        result, seconds, peak_mb = measure(function, *args, repeat=repeat, **function_kwargs)
+        if rows is None:
+            rows = len(result)
+        benchmarks[name] = {"seconds": seconds, "peak_mb": peak_mb, "rows": rows}
+        print(f"{name:<26} {seconds:10.4f} s {peak_mb:10.1f} MB {rows:>10} rows")
+        return result
+
+    raw_data = record("load_csv_data", None, dp.load_csv_data, csv_path)
+    rows = len(raw_data)
+    emission_df = record("prepare_emission_data", rows, dp.prepare_emission_data, raw_data)
+    working_dict = record("seperate_categories", rows, dp.seperate_categories, emission_df,
+                          choose_labels=cf.interesting_gases)
+    countries = emission_df["country_or_area"].unique()
+    record("calc_Results", rows, dp.calc_Results, emission_df, cf.interesting_gases, countries)
+    record("EmissionStore", rows, dp.EmissionStore, emission_df)
+
+    gas_df = working_dict[cf.interesting_gases[0]]
+    record("dataframe_interpolation", len(gas_df), dp.dataframe_interpolation, gas_df, cf.interpolation_intervall)
+
+    series_dict = fc.build_all_series(working_dict, cf.interpolation_intervall,
+                                      countries=list(countries[:forecast_series]), gases=cf.interesting_gases[:1])
+    record("sarimax_forecast", sum(len(series) for series in series_dict.values()),
+           fc.forecast_series, series_dict, workers=1)
+
+    def end_to_end():
+        return gh.Pipeline(data_path=csv_path, memoize=False).run(["analyze", "forecast"])
+    record("pipeline_end_to_end", rows, end_to_end)
+    return benchmarks
+
+
+def compare(benchmarks, baseline, tolerance):
+    """
+    print the change against a baseline and return the benchmarks, which got slower than
+    tolerance (0.2 = 20 %)
+    :param benchmarks: dict
+    :param baseline: dict
+    :param tolerance: float
+    :returns regressions: list of str
+    """
+    regressions = []
+    for name, numbers in benchmarks.items():
+        if name not in baseline:
+            continue
+        time_change = numbers["seconds"] / baseline[name]["seconds"] - 1
+        memory_change = numbers["peak_mb"] / max(baseline[name]["peak_mb"], 1e-9) - 1
+        print(f"{name:<26} time {time_change:+8.1%}   memory {memory_change:+8.1%}")
+        if time_change > tolerance or memory_change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmarks of the greenhouse data pipeline")
+    parser.add_argument("--scale", type=int, default=1, help="multiplies the number of countries")
+    parser.add_argument("--countries", type=int, default=43)
+    parser.add_argument("--gases", type=int, default=10)
+    parser.add_argument("--years", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--forecast-series", type=int, default=5)
+    parser.add_argument("--save-baseline", default=None, help="json file to store the results")
+    parser.add_argument("--compare", default=None, help="json file of a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    emission_df = make_synthetic_data(args.countries * args.scale, args.gases, args.years)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        csv_path = Path(temp_dir).joinpath("Greenhouse_synthetic.csv")
+        emission_df.to_csv(csv_path, index=False)
+        print(f"synthetic data: {len(emission_df)} rows, {csv_path.stat().st_size / 1024**2:.1f} MB")
+        with isolated_outputs(temp_dir):
+            benchmarks = run_benchmarks(csv_path, repeat=args.repeat, forecast_series=args.forecast_series)
+
+    if args.save_baseline is not None:
+        Path(args.save_baseline).write_text(json.dumps(benchmarks, indent=2))
+    if args.compare is not None:
+        regressions = compare(benchmarks, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if len(regressions) > 0:
+            print("slower than the baseline: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,20 +6,34 @@
 #
 ##########################################################################
 import config_file as cf
+import Data_preperation as dp
+from instrumentation import instrumented
 
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from dateutil.relativedelta import *
+import numpy as np
+import pandas as pd
 
 
 from bokeh.plotting import figure, show
-from bokeh.io import output_file, output_notebook, show
-from bokeh.models import Span, ColumnDataSource
+from bokeh.io import output_file, output_notebook, show, save
+from bokeh.models import Span, ColumnDataSource, Tabs, TabPanel
+from bokeh.resources import CDN, INLINE, Resources
 from bokeh.transform import dodge
 from bokeh.palettes import Category10, Category20
 
+# short legend names of the ten categories in the order of the data set
+short_names = ["CO2", "GHGs_CO2", "GHGs", "HFC", "CH4", "NF3", "N2O", "PFC", "SF6", "mix"]
+# legend names of the short category labels, both greenhouse gas categories share one label
+legend_names = {"carbon_dioxide_co2": "CO2", "greenhouse_gas_ghgs": "GHGs", "hydrofluorocarbons_hfcs_emissions": "HFC",
+                "methane_ch4_emissions": "CH4", "nitrogen_trifluoride_nf3": "NF3", "nitrous_oxide_n2o": "N2O",
+                "perfluorocarbons_pfcs_emissions": "PFC", "sulphur_hexafluoride_sf6": "SF6", "unspecified_mix_of": "mix"}
+
 ######################################################################
 
+@instrumented
 def plot_train_test(train, test, **kwargs):
     """
     creates a bokeh plot from the train and test set.
@@ -27,31 +41,33 @@ def plot_train_test(train, test, **kwargs):
     :param test: pandas.DataFrame
     :kwarg output_name: str
     :kwarg title: str
+    :kwarg headless: bool only save the plot, do not open it
+    :kwarg large_data: bool WebGL and downsampling of long series
+    :returns p: bokeh.plotting.figure
     """
     output_name = kwargs.get("output_name", cf.save_train_test_name)
     title_name = kwargs.get("title", "Train-Test- Split European SF6 emmission")
 
-    output_notebook()
-
     p = figure(
         title= title_name,
         x_axis_label="Time",
         y_axis_label="Value",
         x_axis_type="datetime",
         width=1000,
-        height=800
+        height=800,
+        output_backend=_output_backend(**kwargs)
     )
 
     # Plot the train data
     p.line(
-        train.index, train["y"],
+        "x", "y", source=_line_source(train.index, train["y"], **kwargs),
         line_width=2, color="blue",
         legend_label="Train Data"
     )
 
     # Plot the test data
     p.line(
-        test.index, test["y"],
+        "x", "y", source=_line_source(test.index, test["y"], **kwargs),
         line_width=2, color="green",
         legend_label="Test Data"
     )
@@ -77,20 +93,11 @@ def plot_train_test(train, test, **kwargs):
     p.yaxis.major_label_text_font_size = "10pt"
     p.title.text_font_size = '24pt'
 
-    if output_name.find(".html") != -1:
-            saving_path = output_name
-    else:
-        saving_path = output_name + ".html"
-    correct_path = str(Path(__file__).parents[0].joinpath(
-            "Results/" + saving_path))
-
-    output_file(correct_path)
-
-    # Show the plot
-    show(p)
+    return _output_plot(p, output_name, title_name, **kwargs)
 
 
     
+@instrumented
 def plot_all_gases(em_data, names, categories, **kwargs):
     """
     creates a bokeh plot from the train and test set.
@@ -98,23 +105,25 @@ def plot_all_gases(em_data, names, categories, **kwargs):
     :param test: pandas.DataFrame
     :kwarg output_name: str
     :kwarg title: str
+    :kwarg headless: bool only save the plot, do not open it
+    :kwarg large_data: bool WebGL and downsampling of long series
+    :returns p: bokeh.plotting.figure
     """
     output_name = kwargs.get("output_name", cf.save_all_gases_name)
     title_name = kwargs.get("title", "All gases for one country")
 
     em_data=em_data.rename(columns={"value":"y"})
-    short_names =["CO2", "GHGs_CO2", "GHGs", "HFC", "CH4", "NF3", "N2O", "PFC", "SF6", "mix"]
     legend_dict = {key:val for key,val in zip(names,short_names)}
+    legend_dict.update({key:val for key,val in legend_names.items() if key in names})
     
-    output_notebook()
-
     p = figure(
         title=title_name,
         x_axis_label="Time",
         y_axis_label="Value",
         x_axis_type="datetime",
         width=800,
-        height=400
+        height=400,
+        output_backend=_output_backend(**kwargs)
     )
     
     # Generate colors for each category
@@ -126,7 +135,7 @@ def plot_all_gases(em_data, names, categories, **kwargs):
         category_data = em_data[em_data["category"] == category]
         
         p.line(
-            category_data.index, category_data["y"],
+            "x", "y", source=_line_source(category_data.index, category_data["y"], **kwargs),
             line_width=2, color=palette[i % len(palette)],  # Cycle through colors if needed
             legend_label=legend_dict[category]
         )
@@ -136,45 +145,49 @@ def plot_all_gases(em_data, names, categories, **kwargs):
     p.legend.location = "top_left"
     p.legend.click_policy = "hide"
 
-    # Show the plot
-    if output_name.find(".html") != -1:
-            saving_path = output_name
-    else:
-        saving_path = output_name + ".html"
-    correct_path = str(Path(__file__).parents[0].joinpath(
-            "Results/" + saving_path))
-
-    output_file(correct_path)
-
-    # Show the plot
-    show(p)
+    return _output_plot(p, output_name, title_name, **kwargs)
 
 
+@instrumented
 def plot_prediction(train,test,backtest_df,forecast_df, **kwargs):
     """
-    using bokeh for plotting the prediction of the SF6 emissions in Europe
+    using bokeh for plotting the prediction of the SF6 emissions in Europe. Prediction intervals
+    (columns y_lower and y_upper of backtest_df and forecast_df) are drawn as bands.
+    :kwarg output_name: str
+    :kwarg title: str
+    :kwarg alpha: float 1 - confidence of the intervals, only for the legend
+    :kwarg headless: bool only save the plot, do not open it
+    :kwarg large_data: bool WebGL and downsampling of long series
+    :returns p: bokeh.plotting.figure
     """
     output_name = kwargs.get("output_name", cf.save_prediction_name)
     title_name = kwargs.get("title", "Greenhouse Gas Emissions Forecast")
-    output_notebook()
+    alpha = kwargs.get("alpha", cf.forecast_alpha)
     p = figure(title=title_name,
             x_axis_label='Year', 
             y_axis_label='SF6 Emissions in KT',
             x_axis_type='datetime', 
             width=1200, 
-            height=800)
+            height=800,
+            output_backend=_output_backend(**kwargs))
+
+    # Add prediction intervals below the lines
+    for prediction_df, color in [(backtest_df, "orange"), (forecast_df, "red")]:
+        if "y_lower" in prediction_df.columns and len(prediction_df) > 0:
+            p.varea(x="x", y1="lower", y2="upper", source=_band_source(prediction_df), fill_color=color,
+                    fill_alpha=0.2, legend_label=f"{(1 - alpha)*100:g}% Interval")
 
     # Add training data
-    p.line(train.index, train['y'], color="blue", legend_label="Train Data", line_width=2)
+    p.line("x", "y", source=_line_source(train.index, train['y'], **kwargs), color="blue", legend_label="Train Data", line_width=2)
 
     # Add testing data
-    p.line(test.index, test['y'], color="green", legend_label="Test Data", line_width=2)
+    p.line("x", "y", source=_line_source(test.index, test['y'], **kwargs), color="green", legend_label="Test Data", line_width=2)
 
     # Add backtesting predictions
-    p.line(backtest_df.index, backtest_df['y'], color="orange", legend_label="Backtest Predictions", line_width=2)
+    p.line("x", "y", source=_line_source(backtest_df.index, backtest_df['y'], **kwargs), color="orange", legend_label="Backtest Predictions", line_width=2)
 
     # Add future predictions
-    p.line(forecast_df.index, forecast_df['y'], color="red", legend_label="Forecast", line_dash="dashed", line_width=2)
+    p.line("x", "y", source=_line_source(forecast_df.index, forecast_df['y'], **kwargs), color="red", legend_label="Forecast", line_dash="dashed", line_width=2)
 
     # Add a vertical line to indicate where training ends
     split_line = Span(location=train.index[-1].timestamp() * 1000,  # Convert timestamp for Bokeh
@@ -194,15 +207,310 @@ def plot_prediction(train,test,backtest_df,forecast_df, **kwargs):
     p.yaxis.major_label_text_font_size = "14pt"
     p.title.text_font_size = '24pt'
 
-    # Show the plot
-    if output_name.find(".html") != -1:
-                saving_path = output_name
+    return _output_plot(p, output_name, title_name, **kwargs)
+
+
+
+def _output_backend(**kwargs):
+    """
+    WebGL backend for large data, otherwise the default canvas
+    :kwarg large_data: bool
+    :returns: str
+    """
+    if kwargs.get("large_data", cf.large_data_plots):
+        return "webgl"
+    return "canvas"
+
+
+def _line_source(index, values, **kwargs):
+    """
+    ColumnDataSource of one line with numpy columns (bokeh sends them in binary form).
+    For large data the line is downsampled to the point budget.
+    :param index: pandas.Index time or numeric x values
+    :param values: pandas.Series
+    :kwarg large_data: bool
+    :kwarg point_budget: int maximum number of points per line
+    :kwarg downsampling: str "lttb" or "minmax"
+    :returns: bokeh.models.ColumnDataSource
+    """
+    large_data = kwargs.get("large_data", cf.large_data_plots)
+    point_budget = kwargs.get("point_budget", cf.plot_point_budget)
+    downsampling = kwargs.get("downsampling", cf.plot_downsampling)
+
+    x = _x_values(index)
+    y = np.asarray(values, dtype="float64")
+
+    if large_data and len(x) > point_budget:
+        finite = np.isfinite(y)
+        x, y = x[finite], y[finite]
+        if downsampling == "lttb":
+            x, y = downsample_lttb(x, y, point_budget)
+        elif downsampling == "minmax":
+            x, y = downsample_minmax(x, y, point_budget)
+        else:
+            raise ValueError(f"unknown downsampling: {downsampling}, choose lttb or minmax")
+    return ColumnDataSource(data={"x": x, "y": y})
+
+
+def _x_values(index):
+    """
+    x values for bokeh, datetimes as milliseconds since epoch
+    :param index: pandas.Index
+    :returns: numpy.ndarray
+    """
+    if isinstance(index, pd.DatetimeIndex) or pd.api.types.is_datetime64_any_dtype(index):
+        return pd.DatetimeIndex(index).as_unit("ns").asi8 / 1e6
+    return np.asarray(index, dtype="float64")
+
+
+def _band_source(prediction_df):
+    """
+    ColumnDataSource of the prediction interval (columns y_lower and y_upper) for varea
+    :param prediction_df: pandas.DataFrame
+    :returns: bokeh.models.ColumnDataSource
+    """
+    return ColumnDataSource(data={"x": _x_values(prediction_df.index),
+                                  "lower": prediction_df["y_lower"].to_numpy(dtype="float64"),
+                                  "upper": prediction_df["y_upper"].to_numpy(dtype="float64")})
+
+
+def downsample_lttb(x, y, n_out):
+    """
+    largest triangle three buckets downsampling: keeps first and last point and from every bucket
+    the point, which forms the largest triangle with the point chosen before and the mean of
+    the next bucket.
+    :param x: numpy.ndarray sorted
+    :param y: numpy.ndarray
+    :param n_out: int number of returned points
+    :returns x, y: numpy.ndarray
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        mean_x = x[end:next_end].mean()
+        mean_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - mean_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (mean_y - y[previous]))
+        previous = start + np.argmax(area)
+        selected[bucket + 1] = previous
+    return x[selected], y[selected]
+
+
+def downsample_minmax(x, y, n_out):
+    """
+    min/max downsampling: keeps the smallest and the largest point of n_out/2 buckets
+    :param x: numpy.ndarray sorted
+    :param y: numpy.ndarray
+    :param n_out: int maximum number of returned points
+    :returns x, y: numpy.ndarray
+    """
+    n = len(x)
+    n_buckets = n_out // 2
+    if n <= n_out or n_buckets < 1:
+        return x, y
+    bucket_size = -(-n // n_buckets)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, bucket_size)
+    filled = ~np.isnan(padded).all(axis=1)
+    offsets = np.arange(n_buckets)[filled] * bucket_size
+    selected = np.concatenate([offsets + np.nanargmin(padded[filled], axis=1),
+                               offsets + np.nanargmax(padded[filled], axis=1)])
+    selected = np.unique(selected)
+    return x[selected], y[selected]
+
+
+def _results_path(output_name):
+    """
+    path of an html file in the Results folder
+    :param output_name: str
+    :returns: Windows.Path
+    """
+    if output_name.find(".html") == -1:
+        output_name = output_name + ".html"
+    return Path(__file__).parents[0].joinpath("Results/" + output_name)
+
+
+def _output_plot(p, file_name, plot_title, **kwargs):
+    """
+    save the plot in the Results folder. Headless the html file (and optional a png or svg image)
+    is written without opening anything, otherwise the plot is shown in the notebook or browser.
+    :param p: bokeh.plotting.figure
+    :param file_name: str
+    :param plot_title: str
+    :kwarg headless: bool
+    :kwarg image_format: str "png", "svg" or None
+    :returns p: bokeh.plotting.figure
+    """
+    headless = kwargs.get("headless", cf.headless_plots)
+    image_format = kwargs.get("image_format", cf.plot_image_format)
+
+    saving_path = _results_path(file_name)
+    if not headless:
+        output_notebook()
+        output_file(str(saving_path))
+        show(p)
+        return p
+
+    saving_path.parent.mkdir(parents=True, exist_ok=True)
+    save(p, filename=saving_path, resources=CDN, title=plot_title)
+    if image_format is not None:
+        _export_image(p, saving_path.with_suffix("." + image_format), image_format)
+    return p
+
+
+def _export_image(p, image_path, image_format):
+    """
+    export a static image of the plot, needs selenium and a local chrome or firefox webdriver
+    :param p: bokeh.plotting.figure
+    :param image_path: Windows.Path
+    :param image_format: str "png" or "svg"
+    """
+    from bokeh.io import export_png, export_svg
+
+    if image_format == "png":
+        export_png(p, filename=image_path)
+    elif image_format == "svg":
+        backend = p.output_backend
+        p.output_backend = "svg"
+        try:
+            export_svg(p, filename=image_path)
+        finally:
+            p.output_backend = backend
     else:
-            saving_path = output_name + ".html"
-    correct_path = str(Path(__file__).parents[0].joinpath(
-                "Results/" + saving_path))
+        raise ValueError(f"unknown image_format: {image_format}, choose png, svg or None")
+
+
+def _report_resources(resources, saving_path):
+    """
+    bokeh resources of the report files. "cdn" and "relative" link one shared BokehJS
+    (from the CDN or the local bokeh installation) instead of writing it into every file.
+    :param resources: str "cdn", "relative" or "inline"
+    :param saving_path: Windows.Path
+    :returns: bokeh.resources.Resources
+    """
+    if resources == "cdn":
+        return CDN
+    elif resources == "relative":
+        return Resources(mode="relative", root_dir=str(saving_path.parent))
+    elif resources == "inline":
+        return INLINE
+    else:
+        raise ValueError(f"unknown resources: {resources}, choose cdn, relative or inline")
+
+
+def _country_figure(country, source, categories, title_name):
+    """
+    plot all gases of one country from one ColumnDataSource with a column per category
+    :param country: str
+    :param source: bokeh.models.ColumnDataSource
+    :param categories: list
+    :param title_name: str
+    :returns p: bokeh.plotting.figure
+    """
+    legend_dict = {key:val for key,val in zip(categories,short_names)}
+    legend_dict.update({key:val for key,val in legend_names.items() if key in categories})
+    palette = Category10[10] if len(categories) <= 10 else Category20[20]
+
+    p = figure(
+        title=title_name + country,
+        x_axis_label="Time",
+        y_axis_label="Value",
+        x_axis_type="datetime",
+        width=800,
+        height=400
+    )
+    for i, category in enumerate(categories):
+        if category in source.data:
+            p.line(
+                "year", category, source=source,
+                line_width=2, color=palette[i % len(palette)],
+                legend_label=legend_dict[category]
+            )
 
-    output_file(correct_path)
+    p.legend.title = "Categories"
+    p.legend.location = "top_left"
+    p.legend.click_policy = "hide"
+    return p
 
-    # Show the plot
-    show(p)
+
+def _render_country_page(task):
+    """
+    build and save the page of one country (used in the process pool)
+    :param task: tuple (country, country_data, categories, title_name, saving_path, resources)
+    :returns saving_path: Windows.Path
+    """
+    country, country_data, categories, title_name, saving_path, resources = task
+    source = ColumnDataSource(country_data)
+    p = _country_figure(country, source, categories, title_name)
+    save(p, filename=saving_path, resources=_report_resources(resources, saving_path),
+         title=title_name + country)
+    return saving_path
+
+
+@instrumented
+def plot_all_countries_report(em_data, categories, **kwargs):
+    """
+    plots all gases of every country without opening a browser. The data is pivoted once into a
+    table with one column per category and each country gets one ColumnDataSource shared by
+    all of its lines. mode "tabs" writes one html file with a tab per country, mode "pages" writes
+    one file per country in a process pool.
+
+    :param em_data: pandas.DataFrame
+    :param categories: list
+    :kwarg output_name: str file name (tabs) or suffix of the file names (pages)
+    :kwarg title: str title, the country name is appended
+    :kwarg mode: str "tabs" or "pages"
+    :kwarg resources: str "cdn", "relative" or "inline"
+    :kwarg workers: int worker processes for mode "pages", 1 renders in this process
+    :returns: list of the saved paths
+    """
+    output_name = kwargs.get("output_name", cf.save_report_name)
+    title_name = kwargs.get("title", "all emssions of: ")
+    mode = kwargs.get("mode", cf.report_mode)
+    resources = kwargs.get("resources", cf.report_resources)
+    workers = kwargs.get("workers", cf.report_workers) or os.cpu_count()
+
+    # duplicated short labels are merged, the first series is plotted
+    categories = list(dict.fromkeys(categories))
+    em_data = em_data[em_data["category"].isin(categories)]
+    wide_data = em_data.assign(year=dp.year_dates(em_data))\
+                       .pivot_table(index=["country_or_area", "year"], columns="category",
+                                    values="value", aggfunc="first", observed=True)
+    wide_data.columns = wide_data.columns.astype(str)
+    country_data = {country: one_country.droplevel(0).sort_index()
+                    for country, one_country in wide_data.groupby(level=0, sort=False, observed=True)}
+
+    if mode == "tabs":
+        saving_path = _results_path(output_name)
+        saving_path.parent.mkdir(parents=True, exist_ok=True)
+        panels = []
+        for country, one_country in country_data.items():
+            p = _country_figure(country, ColumnDataSource(one_country), categories, title_name)
+            panels.append(TabPanel(child=p, title=country))
+        save(Tabs(tabs=panels), filename=saving_path,
+             resources=_report_resources(resources, saving_path), title=title_name.strip(": "))
+        return [saving_path]
+
+    elif mode == "pages":
+        tasks = []
+        for country, one_country in country_data.items():
+            saving_path = _results_path(country + "_" + output_name)
+            tasks.append((country, one_country, categories, title_name, saving_path, resources))
+        if len(tasks) > 0:
+            tasks[0][4].parent.mkdir(parents=True, exist_ok=True)
+        if workers == 1:
+            return list(map(_render_country_page, tasks))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_render_country_page, tasks))
+
+    else:
+        raise ValueError(f"unknown mode: {mode}, choose tabs or pages")
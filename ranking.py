@@ -0,0 +1,225 @@
+## module:: Data challenge ranking
+#     :platform:   Windows
+#     :synopsis:   top k rankings of the countries for registered metrics
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+a metric turns the yearly values of every gas/country series into one number (or, for row metrics,
+ranks the single yearly values). New metrics are added with the register_metric decorator:
+
+    @register_metric("median")
+    def median(grouped, **kwargs):
+        return grouped["value"].median()
+
+rank selects the k largest or smallest entries of every gas with np.partition instead of
+sorting all of them. The table has the same columns as Data_preperation.tidy_results.
+"""
+import numpy as np
+import pandas as pd
+
+import Data_preperation as dp
+import config_file as cf
+from instrumentation import instrumented
+
+# name -> (function, row metric)
+metrics = {}
+
+######################################################################
+
+def register_metric(name, **kwargs):
+    """
+    decorator to add a metric. The function gets the data grouped by category and country
+    (sorted by year) and returns a pandas.Series with (category, country) as index. Row metrics
+    (row=True) get the data frame of the rows instead and return one value per row.
+    :param name: str
+    :kwarg row: bool
+    """
+    row = kwargs.get("row", False)
+
+    def decorator(function):
+        metrics[name] = (function, row)
+        return function
+    return decorator
+
+
+@register_metric("year_value", row=True)
+def year_value(em_data, **kwargs):
+    """emission of a single year (max-year/min-year of calc_Results)"""
+    return em_data["value"]
+
+
+@register_metric("total")
+def total(grouped, **kwargs):
+    """sum of all years"""
+    return grouped["value"].sum()
+
+
+@register_metric("mean")
+def mean(grouped, **kwargs):
+    """mean of all years"""
+    return grouped["value"].mean()
+
+
+@register_metric("first_to_last")
+def first_to_last(grouped, **kwargs):
+    """relative change from the first to the last year"""
+    values = grouped["value"]
+    return values.last() / values.first() - 1
+
+
+@register_metric("cagr")
+def cagr(grouped, **kwargs):
+    """compound annual growth rate between the first and the last year"""
+    values = grouped["value"]
+    years = grouped["year"]
+    n_years = (years.last() - years.first()).astype("float64")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = (values.last() / values.first()) ** (1 / n_years.where(n_years > 0)) - 1
+    return growth
+
+
+@register_metric("yoy_delta")
+def yoy_delta(grouped, **kwargs):
+    """change of the last year to the year before"""
+    rows = grouped.obj
+    delta = grouped["value"].diff()
+    return delta.groupby([rows["category"], rows["country_or_area"]], observed=True, sort=False).last()
+
+
+@register_metric("improvement")
+def improvement(grouped, **kwargs):
+    """maximum divided by the value of the first year (most-improved of calc_Results, ordered by year)"""
+    values = grouped["value"]
+    return values.max() / values.first()
+
+
+@register_metric("ratio")
+def ratio(grouped, **kwargs):
+    """
+    sum of the emissions divided by the sum of a denominator over the same years, e.g. the population
+    for per capita emissions. Needs the kwarg denominator: pandas.Series with (country, year) as index
+    """
+    denominator = kwargs.get("denominator", None)
+    if denominator is None:
+        raise ValueError("the metric ratio needs a denominator (pandas.Series with (country, year) index)")
+    rows = grouped.obj
+    divisor = denominator.reindex(pd.MultiIndex.from_arrays([rows["country_or_area"].astype(str),
+                                                             rows["year"].astype("int64")])).to_numpy()
+    divisor_sum = rows.assign(divisor=divisor).groupby(["category", "country_or_area"], observed=True,
+                                                       sort=False)["divisor"].sum(min_count=1)
+    return grouped["value"].sum() / divisor_sum
+
+
+def top_k(values, k, largest=True):
+    """
+    positions of the k largest (or smallest) values, best first, NaN and inf are left out.
+    np.partition finds the k-th best value in linear time, everything better is taken and the ties
+    of the k-th value fill up in the order of the data like nlargest. Only the k values are sorted.
+    :param values: numpy.ndarray
+    :param k: int
+    :param largest: bool
+    :returns: numpy.ndarray of int
+    """
+    finite = np.flatnonzero(np.isfinite(values))
+    keys = -values[finite] if largest else values[finite]
+    if k < 1:
+        return finite[:0]
+    if k < len(keys):
+        threshold = np.partition(keys, k - 1)[k - 1]
+        better = np.flatnonzero(keys < threshold)
+        ties = np.flatnonzero(keys == threshold)[:k - len(better)]
+        selected = np.concatenate([better, ties])
+    else:
+        selected = np.arange(len(keys))
+    # stable sort by value and position, so ties keep the order of the data like nlargest
+    selected = selected[np.lexsort((finite[selected], keys[selected]))]
+    return finite[selected]
+
+
+def _window(em_data, gases, countries, years):
+    """
+    rows of the chosen gases, countries and years, sorted by year within every series
+    """
+    mask = em_data["category"].isin(gases)
+    if countries is not None:
+        mask &= em_data["country_or_area"].isin(countries)
+    if years is not None:
+        first_year, last_year = years
+        year = em_data["year"] if em_data["year"].dtype.kind in "iu" else dp.year_dates(em_data).dt.year
+        mask &= year.between(first_year if first_year is not None else -np.inf,
+                             last_year if last_year is not None else np.inf)
+    window = em_data[mask]
+    if window["year"].dtype.kind not in "iu":
+        window = window.assign(year=dp.year_dates(window).dt.year)
+    return window.sort_values("year", kind="stable")
+
+
+@instrumented
+def rank(em_data, metric, **kwargs):
+    """
+    the k countries (or for row metrics the k rows) with the largest or smallest metric for every gas
+    :param em_data: pandas.DataFrame (compact schema) or Data_preperation.EmissionStore
+    :param metric: str a registered metric
+    :kwarg k: int
+    :kwarg largest: bool
+    :kwarg gases: list default interesting_gases
+    :kwarg countries: list default all countries
+    :kwarg years: tuple (first year, last year), None or None entries for no limit
+    :kwarg name: str metric name in the table, default metric + "-max"/"-min"
+    :kwarg denominator: pandas.Series for the metric ratio
+    :returns ranking_df: pandas.DataFrame with the columns of Data_preperation.tidy_results
+    """
+    k = kwargs.get("k", cf.ranking_k)
+    largest = kwargs.get("largest", True)
+    gases = kwargs.get("gases", cf.interesting_gases)
+    countries = kwargs.get("countries", None)
+    years = kwargs.get("years", cf.ranking_years)
+    name = kwargs.get("name", metric + ("-max" if largest else "-min"))
+
+    if metric not in metrics:
+        raise ValueError(f"unknown metric: {metric}, registered are: {list(metrics)}")
+    function, row = metrics[metric]
+    if isinstance(em_data, dp.EmissionStore):
+        em_data = em_data.data
+    window = _window(em_data, gases, countries, years)
+
+    if row:
+        values = pd.Series(np.asarray(function(window, **kwargs), dtype="float64"), index=window.index)
+        keys = window[["category", "country_or_area", "year"]]
+    else:
+        grouped = window.groupby(["category", "country_or_area"], observed=True, sort=False)
+        values = function(grouped, **kwargs).astype("float64")
+        keys = values.index.to_frame(index=False).assign(year=pd.NA)
+        values = pd.Series(values.to_numpy(), index=keys.index)
+
+    parts = []
+    categories = keys["category"].astype(str).to_numpy()
+    for gas in gases:
+        positions = np.flatnonzero(categories == gas)
+        best = positions[top_k(values.to_numpy()[positions], k, largest)]
+        parts.append(pd.DataFrame({
+            "metric": name,
+            "gas": gas,
+            "rank": np.arange(1, len(best) + 1, dtype="int16"),
+            "country": keys["country_or_area"].astype(str).to_numpy()[best],
+            "year": pd.array(keys["year"].to_numpy()[best], dtype="Int16"),
+            "value": values.to_numpy()[best],
+        }))
+    return pd.concat(parts, ignore_index=True)[dp.result_columns]
+
+
+def rank_many(em_data, metric_names, **kwargs):
+    """
+    rank for several metrics, largest and smallest, in one table
+    :param em_data: pandas.DataFrame or Data_preperation.EmissionStore
+    :param metric_names: list of str
+    :kwarg: see rank
+    :returns ranking_df: pandas.DataFrame
+    """
+    if isinstance(em_data, dp.EmissionStore):
+        em_data = em_data.data
+    tables = [rank(em_data, metric, largest=largest, **kwargs)
+              for metric in metric_names for largest in [True, False]]
+    return pd.concat(tables, ignore_index=True)
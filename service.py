@@ -0,0 +1,275 @@
+## module:: Data challenge query service
+#     :platform:   Windows
+#     :synopsis:   local http service for rankings, series and forecasts of the loaded data
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+loads and indexes the emission data once and answers queries as json:
+
+    python service.py --port 8050
+
+    /gases                                           short labels of all gases
+    /countries                                       all countries
+    /rankings?metric=max-total&gas=carbon_dioxide_co2  calc_Results rankings (metric "all" by default)
+    /rankings?metric=cagr&k=5&first_year=2000&order=min  rankings of the metrics of ranking.py
+    /series?country=European Union&gas=sulphur_hexafluoride_sf6
+    /forecast?country=European Union&gas=sulphur_hexafluoride_sf6&steps=30
+
+rankings and forecasts are kept in a cache with at most service_cache_size entries for
+service_cache_ttl seconds. Unknown countries or gases (and combinations without values) are
+answered with 404, missing or wrong parameters with 400 and every other error with 500, always
+with {"error": message}.
+"""
+import argparse
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import Data_preperation as dp
+import config_file as cf
+import Greenhouse as gh
+
+######################################################################
+
+class TTLCache:
+    """
+    least recently used cache, which also forgets entries older than ttl seconds
+
+    :param maxsize: int
+    :param ttl: float seconds
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        cached value of key, compute() is called on a miss (outside of the lock)
+        :param key: hashable
+        :param compute: callable without arguments
+        """
+        now = time.monotonic()
+        with self.lock:
+            if key in self.entries:
+                created, value = self.entries[key]
+                if now - created < self.ttl:
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+
+        value = compute()
+        with self.lock:
+            self.entries[key] = (now, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+
+class NotFound(KeyError):
+    """
+    unknown country, gas or path, or a country/gas combination without values (answered with 404)
+    """
+
+
+class BadRequest(ValueError):
+    """
+    missing or invalid query parameters (answered with 400)
+    """
+
+
+class EmissionService:
+    """
+    the prepared emission data (Greenhouse.Pipeline up to the prepare stage) and the queries on it.
+    All query methods return json serializable objects, unknown countries or gases raise NotFound,
+    wrong parameters BadRequest.
+
+    :kwarg data_path: Windows.Path
+    :kwarg cache_size: int
+    :kwarg cache_ttl: float seconds
+    """
+
+    def __init__(self, **kwargs):
+        self.pipeline = gh.Pipeline(data_path=kwargs.get("data_path", cf.emission_data_path))
+        self.pipeline.run_stage("prepare")
+        self.store = self.pipeline.store
+        self.countries = [str(country) for country in self.pipeline.countries]
+        self.gases = [str(gas) for gas in self.pipeline.categories]
+        self.cache = TTLCache(kwargs.get("cache_size", cf.service_cache_size),
+                              kwargs.get("cache_ttl", cf.service_cache_ttl))
+
+    def _check(self, country=None, gases=()):
+        if country is not None and country not in self.countries:
+            raise NotFound(f"unknown country: {country}")
+        for gas in gases:
+            if gas not in self.gases:
+                raise NotFound(f"unknown gas: {gas}")
+
+    def rankings(self, metric="all", gases=None, k=None, years=None, largest=True):
+        """
+        rankings of calc_Results (rating types or "all") or of a metric registered in ranking.py
+        as rows of Data_preperation.tidy_results
+        :param metric: str
+        :param gases: list, default interesting_gases
+        :param k: int, default ranking_k
+        :param years: tuple (first year, last year) or None
+        :param largest: bool only for the ranking.py metrics
+        :returns: list of dict
+        """
+        import ranking as rk
+
+        gases = tuple(gases) if gases else tuple(cf.interesting_gases)
+        k = _integer(k, "k") if k is not None else cf.ranking_k
+        self._check(gases=gases)
+        if k <= 0:
+            raise BadRequest("k must be positive")
+        rating_types = ["max-year", "min-year", "max-total", "min-total", "most-improved"]
+        if metric != "all" and metric not in rating_types and metric not in rk.metrics:
+            raise BadRequest(f"unknown metric: {metric}")
+
+        def compute():
+            if metric in rk.metrics:
+                return _records(rk.rank(self.store, metric, k=k, years=years, largest=largest, gases=list(gases)))
+            results_dict = dp.calc_Results(self.store, list(gases), self.pipeline.countries, rating_type=metric,
+                                           k=k, years=years)
+            return _records(dp.tidy_results(results_dict))
+        return self.cache.get(("rankings", metric, gases, k, years, largest), compute)
+
+    def series(self, country, gas):
+        """
+        yearly values of one country and gas
+        :returns: list of dict with year and value
+        """
+        self._check(country, [gas])
+        one_series = self.store.series(country, gas)
+        if len(one_series) == 0:
+            raise NotFound(f"no values of {gas} for {country}")
+        return [{"year": int(year), "value": float(value)}
+                for year, value in zip(one_series["year"], one_series["value"])]
+
+    def forecast(self, country, gas, steps=None):
+        """
+        SARIMAX forecast of the interpolated series (forecasting.fit_forecast)
+        :returns: dict with the lists train, test, backtest and forecast (with y_lower and y_upper)
+        """
+        import forecasting as fc
+
+        steps = _integer(steps, "steps") if steps is not None else cf.forecast_steps
+        if steps <= 0:
+            raise BadRequest("steps must be positive")
+        self._check(country, [gas])
+        if (country, gas) not in self.store:
+            raise NotFound(f"no values of {gas} for {country}")
+
+        def compute():
+            series_dict = fc.build_series(self.store, [(country, gas)], cf.interpolation_intervall)
+            parts = fc.fit_forecast(series_dict[(country, gas)], steps=steps)
+            return {name: _records(part.rename_axis("date").reset_index())
+                    for name, part in zip(["train", "test", "backtest", "forecast"], parts)}
+        return self.cache.get(("forecast", country, gas, steps), compute)
+
+    def query(self, path, parameters):
+        """
+        answer one request
+        :param path: str e.g. "/series"
+        :param parameters: dict of lists (urllib.parse.parse_qs)
+        :returns status, payload: int, json serializable object
+        """
+        def single(name, default=None):
+            return parameters.get(name, [default])[0]
+
+        def required(name):
+            if name not in parameters:
+                raise BadRequest(f"missing parameter: {name}")
+            return single(name)
+
+        try:
+            if path == "/gases":
+                return 200, self.gases
+            if path == "/countries":
+                return 200, self.countries
+            if path == "/rankings":
+                years = None
+                if "first_year" in parameters or "last_year" in parameters:
+                    years = tuple(_integer(single(name), name) if name in parameters else None
+                                  for name in ["first_year", "last_year"])
+                return 200, self.rankings(single("metric", "all"), parameters.get("gas"), single("k"), years,
+                                          single("order", "max") != "min")
+            if path == "/series":
+                return 200, self.series(required("country"), required("gas"))
+            if path == "/forecast":
+                return 200, self.forecast(required("country"), required("gas"), single("steps"))
+            raise NotFound(f"unknown path: {path}")
+        except NotFound as error:
+            return 404, {"error": error.args[0]}
+        except BadRequest as error:
+            return 400, {"error": str(error)}
+        except Exception as error:
+            # the client always gets an answer, the traceback goes to the server log
+            traceback.print_exc()
+            return 500, {"error": f"internal error: {type(error).__name__}: {error}"}
+
+
+def _integer(value, name):
+    """
+    query parameter as int, BadRequest if it is not a number
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be an integer, got: {value}") from None
+
+
+def _records(dataframe):
+    """
+    rows of a dataframe as list of dicts, missing values as None and dates as iso strings
+    """
+    return json.loads(dataframe.to_json(orient="records", date_format="iso"))
+
+
+def make_handler(service):
+    """
+    request handler class for http.server, which answers with service.query
+    :param service: EmissionService
+    """
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            status, payload = service.query(url.path.rstrip("/") or "/", parse_qs(url.query))
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return QueryHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="json service for the greenhouse gas data")
+    parser.add_argument("--data", default=cf.emission_data_path, help="csv file of the emission data")
+    parser.add_argument("--host", default=cf.service_host)
+    parser.add_argument("--port", type=int, default=cf.service_port)
+    args = parser.parse_args(argv)
+
+    service = EmissionService(data_path=args.data)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"serving {len(service.countries)} countries on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+## module:: Data challenge vectorized ARIMA
+#     :platform:   Windows
+#     :synopsis:   ARIMA(p, d, 0) fits and forecasts of many series at once with numpy
+# .. moduleauthor: Peter Stroppa BSc
+#
+#
+##########################################################################
+"""
+instead of one SARIMAX model (kalman filter and optimizer) per series, all series are stacked into
+one matrix (right aligned, shorter series padded with NaN at the start), differenced together and
+the AR coefficients of all series are estimated with one batched least squares solve (conditional
+least squares). The forecasts and their intervals (from the psi weights of the integrated
+model) are calculated for all series at once. For the short interpolated series the
+coefficients are close to the maximum likelihood fit of SARIMAX, see cross_check.
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+import config_file as cf
+from instrumentation import instrumented
+
+######################################################################
+
+def stack_series(y_list):
+    """
+    right aligned matrix of several series, the last values of all series are in the last column
+    :param y_list: list of pandas.Series or numpy arrays
+    :returns values: numpy.ndarray (n_series, longest series), NaN before the start of a series
+    """
+    length = max((len(y) for y in y_list), default=0)
+    values = np.full((len(y_list), length), np.nan)
+    for row, y in enumerate(y_list):
+        if len(y) > 0:
+            values[row, length - len(y):] = np.asarray(y, dtype="float64")
+    return values
+
+
+def fit_arima(values, order, **kwargs):
+    """
+    conditional least squares fit of ARIMA(p, d, 0) for every row of values
+    :param values: numpy.ndarray (n_series, n_times) from stack_series
+    :param order: tuple (p, d, q) with q = 0
+    :kwarg trend: bool estimate a constant of the differenced series (SARIMAX trend "c")
+    :returns fit: dict with ar (n_series, p), const (n_series), sigma2 (n_series), nobs (n_series)
+    """
+    trend = kwargs.get("trend", False)
+    p, d, q = order
+    if q != 0:
+        raise ValueError("vector_arima only supports ARIMA(p, d, 0) models")
+
+    differenced = np.diff(values, n=d, axis=1) if d > 0 else values
+    n_series, n_times = differenced.shape
+    n_times = max(n_times - p, 0)
+
+    target = differenced[:, p:]
+    # lag j of every target value, shape (n_series, n_times, p)
+    lags = np.stack([differenced[:, p - j - 1:p - j - 1 + n_times] for j in range(p)], axis=2) \
+        if p > 0 else np.zeros((n_series, n_times, 0))
+    if trend:
+        lags = np.concatenate([np.ones((n_series, n_times, 1)), lags], axis=2)
+    n_params = lags.shape[2]
+
+    usable = np.isfinite(target) & np.isfinite(lags).all(axis=2)
+    lags = np.where(usable[:, :, None], lags, 0.0)
+    target = np.where(usable, target, 0.0)
+    nobs = usable.sum(axis=1)
+
+    if n_params > 0:
+        normal_matrix = np.einsum("ntj,ntk->njk", lags, lags)
+        normal_vector = np.einsum("ntj,nt->nj", lags, target)
+        # tiny ridge, so series without enough values do not make the batch singular
+        normal_matrix += np.eye(n_params) * 1e-10 * (np.trace(normal_matrix, axis1=1, axis2=2)[:, None, None] + 1)
+        params = np.linalg.solve(normal_matrix, normal_vector[:, :, None])[:, :, 0]
+        residuals = target - np.einsum("ntj,nj->nt", lags, params)
+    else:
+        params = np.zeros((n_series, 0))
+        residuals = target
+    residuals = np.where(usable, residuals, 0.0)
+
+    # maximum likelihood variance like SARIMAX
+    sigma2 = (residuals**2).sum(axis=1) / np.maximum(nobs, 1)
+    params[nobs <= n_params] = np.nan
+
+    return {
+        "order": (p, d, q),
+        "const": params[:, 0] if trend else np.zeros(n_series),
+        "ar": params[:, 1:] if trend else params,
+        "sigma2": sigma2,
+        "nobs": nobs,
+    }
+
+
+def forecast_arima(values, fit, steps, **kwargs):
+    """
+    multi step forecasts and prediction intervals of all series after their last value
+    :param values: numpy.ndarray (n_series, n_times) the series fit_arima was fitted on
+    :param fit: dict from fit_arima
+    :param steps: int
+    :kwarg alpha: float 1 - confidence of the intervals
+    :returns mean, lower, upper: numpy.ndarray (n_series, steps)
+    """
+    alpha = kwargs.get("alpha", 0.05)
+    p, d, _ = fit["order"]
+    ar = fit["ar"]
+    n_series = values.shape[0]
+
+    # last value of every differencing level, needed to integrate the forecasts
+    levels = []
+    differenced = values
+    for _ in range(d):
+        levels.append(differenced[:, -1])
+        differenced = np.diff(differenced, axis=1)
+
+    history = differenced[:, differenced.shape[1] - p:] if p > 0 else np.zeros((n_series, 0))
+    forecasts = np.empty((n_series, steps))
+    for step in range(steps):
+        # history[:, -1] is lag 1
+        next_value = fit["const"] + (ar * history[:, ::-1]).sum(axis=1)
+        forecasts[:, step] = next_value
+        if p > 0:
+            history = np.concatenate([history[:, 1:], next_value[:, None]], axis=1)
+
+    for level in reversed(levels):
+        forecasts = level[:, None] + np.cumsum(forecasts, axis=1)
+
+    # psi weights of phi(L) (1 - L)^d, the variance of step h is sigma2 * sum(psi_0..psi_h-1 ^ 2)
+    polynomial = np.concatenate([np.ones((n_series, 1)), -ar], axis=1)
+    for _ in range(d):
+        polynomial = np.concatenate([polynomial, np.zeros((n_series, 1))], axis=1)
+        polynomial[:, 1:] -= polynomial[:, :-1].copy()
+    coefficients = -polynomial[:, 1:]
+    psi = np.zeros((n_series, steps))
+    psi[:, 0] = 1
+    for h in range(1, steps):
+        n_lags = min(h, coefficients.shape[1])
+        psi[:, h] = (coefficients[:, :n_lags] * psi[:, h - n_lags:h][:, ::-1]).sum(axis=1)
+    spread = norm.ppf(1 - alpha / 2) * np.sqrt(fit["sigma2"][:, None] * np.cumsum(psi**2, axis=1))
+
+    return forecasts, forecasts - spread, forecasts + spread
+
+
+def simulate_arima(values, fit, steps, n_paths, **kwargs):
+    """
+    simulated future paths of all series with normal shocks of variance sigma2, all series and
+    paths are simulated together
+    :param values: numpy.ndarray (n_series, n_times) the series fit_arima was fitted on
+    :param fit: dict from fit_arima
+    :param steps: int
+    :param n_paths: int
+    :kwarg seed: int
+    :returns paths: numpy.ndarray (n_series, n_paths, steps)
+    """
+    rng = np.random.default_rng(kwargs.get("seed", None))
+    p, d, _ = fit["order"]
+    ar = fit["ar"][:, None, :]
+    n_series = values.shape[0]
+
+    levels = []
+    differenced = values
+    for _ in range(d):
+        levels.append(differenced[:, -1])
+        differenced = np.diff(differenced, axis=1)
+
+    shocks = rng.standard_normal((n_series, n_paths, steps)) * np.sqrt(fit["sigma2"])[:, None, None]
+    history = np.repeat(differenced[:, None, differenced.shape[1] - p:], n_paths, axis=1) \
+        if p > 0 else np.zeros((n_series, n_paths, 0))
+    paths = np.empty((n_series, n_paths, steps))
+    for step in range(steps):
+        next_value = fit["const"][:, None] + (ar * history[:, :, ::-1]).sum(axis=2) + shocks[:, :, step]
+        paths[:, :, step] = next_value
+        if p > 0:
+            history = np.concatenate([history[:, :, 1:], next_value[:, :, None]], axis=2)
+
+    for level in reversed(levels):
+        paths = level[:, None, None] + np.cumsum(paths, axis=2)
+    return paths
+
+
+def _future_index(index, steps):
+    """
+    the next steps time stamps after index (positions, if the index has no time stamps; time
+    stamps without a frequency are rejected by forecast_series_vectorized)
+    """
+    freq = getattr(index, "freq", None)
+    if freq is None or len(index) == 0:
+        start = len(index)
+        return pd.RangeIndex(start, start + steps)
+    return pd.date_range(index[-1], periods=steps + 1, freq=freq)[1:]
+
+
+@instrumented
+def forecast_series_vectorized(series_dict, **kwargs):
+    """
+    same table as forecasting.forecast_series (train, test, backtest and forecast of every series),
+    but all series are fitted and forecasted together with ARIMA(p, d, 0). The backtest and forecast
+    rows also get the prediction interval in y_lower and y_upper (and with simulate_paths the
+    quantiles of simulated paths, see forecasting.path_quantiles).
+
+    :param series_dict: dict with (country, gas) as key and a pandas.DataFrame (column "y") as value
+    :kwarg train_percent: float
+    :kwarg order: tuple (p, d, 0)
+    :kwarg seasonal_order: tuple, only (0, 0, 0, s) is supported
+    :kwarg steps: int
+    :kwarg trend: bool
+    :kwarg alpha: float 1 - confidence of the intervals
+    :kwarg simulate_paths: int
+    :returns forecast_table: pandas.DataFrame
+    """
+    from forecasting import check_frequency, path_quantiles
+
+    train_percent = kwargs.get("train_percent", cf.train_percent)
+    order = tuple(kwargs.get("order", cf.sarimax_order))
+    seasonal_order = tuple(kwargs.get("seasonal_order", cf.seasonal_order))
+    steps = kwargs.get("steps", cf.forecast_steps)
+    alpha = kwargs.get("alpha", cf.forecast_alpha)
+    simulate_paths = kwargs.get("simulate_paths", cf.simulate_paths)
+    trend = kwargs.get("trend", False)
+    if any(seasonal_order[:3]):
+        raise ValueError("vector_arima does not support seasonal models")
+
+    columns = ["country_or_area", "category", "year", "y", "y_lower", "y_upper", "type"]
+    keys = list(series_dict.keys())
+    if len(keys) == 0:
+        return pd.DataFrame(columns=columns)
+
+    indexes = [series_dict[key].index for key in keys]
+    for index in indexes:
+        if isinstance(index, pd.DatetimeIndex):
+            check_frequency(index)
+    ys = [series_dict[key]["y"].to_numpy(dtype="float64") for key in keys]
+    splits = [int(round(len(y)*train_percent, 0)) for y in ys]
+
+    values = stack_series([y[:split] for y, split in zip(ys, splits)])
+    fit = fit_arima(values, order, trend=trend)
+    horizon = max([steps] + [len(y) - split for y, split in zip(ys, splits)])
+    mean, lower, upper = forecast_arima(values, fit, horizon, alpha=alpha)
+    intervals = {"y_lower": lower, "y_upper": upper}
+    if simulate_paths > 0:
+        intervals.update(path_quantiles(simulate_arima(values, fit, horizon, simulate_paths), cf.path_quantiles))
+    columns = columns[:4] + list(intervals.keys()) + columns[-1:]
+
+    # the columns of all series are collected as arrays and put together once
+    columns_data = {column: [] for column in columns}
+    # most series end at the same date, their forecast dates are only generated once
+    future_indexes = {}
+    for row, (country, gas) in enumerate(keys):
+        index, y, split = indexes[row], ys[row], splits[row]
+        if split == 0 or not np.isfinite(mean[row]).all():
+            print(f"forecast of {gas} for {country} failed: not enough values")
+            continue
+        n_test = len(y) - split
+        train_index = index[:split]
+        end = (train_index[-1], getattr(index, "freq", None), split)
+        if end not in future_indexes:
+            future_indexes[end] = _future_index(train_index, steps)
+        no_interval = np.full(len(y), np.nan)
+        parts = {
+            "year": [index, index[split:], future_indexes[end]],
+            "y": [y, mean[row, :n_test], mean[row, :steps]],
+            "type": [np.repeat(["train", "test", "backtest", "forecast"], [split, n_test, n_test, steps])],
+        }
+        for name, interval in intervals.items():
+            parts[name] = [no_interval, interval[row, :n_test], interval[row, :steps]]
+        length = len(y) + n_test + steps
+        parts["country_or_area"] = [np.full(length, country, dtype=object)]
+        parts["category"] = [np.full(length, gas, dtype=object)]
+        for column, arrays in parts.items():
+            columns_data[column].extend(np.asarray(array) for array in arrays)
+
+    if len(columns_data["y"]) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame({column: np.concatenate(arrays) for column, arrays in columns_data.items()})[columns]
+
+
+def cross_check(series_dict, **kwargs):
+    """
+    compare the coefficients and forecasts of fit_arima with statsmodels SARIMAX for every series
+    :param series_dict: dict with (country, gas) as key and a pandas.DataFrame (column "y") as value
+    :kwarg order: tuple (p, d, 0)
+    :kwarg steps: int
+    :returns comparison: pandas.DataFrame with the largest absolute difference of the AR coefficients
+             and the largest forecast difference relative to the last value per series
+    """
+    import forecasting as fc
+
+    order = tuple(kwargs.get("order", cf.sarimax_order))
+    steps = kwargs.get("steps", cf.forecast_steps)
+
+    keys = list(series_dict.keys())
+    values = stack_series([series_dict[key]["y"] for key in keys])
+    fit = fit_arima(values, order)
+    mean, _, _ = forecast_arima(values, fit, steps)
+
+    rows = []
+    for row, key in enumerate(keys):
+        y = series_dict[key]["y"]
+        sarimax_results = fc.fit_sarimax(y, order, (0, 0, 0, 0))
+        sarimax_ar = np.asarray(sarimax_results.arparams)
+        sarimax_mean = np.asarray(sarimax_results.get_forecast(steps=steps).predicted_mean)
+        scale = max(abs(y.iloc[-1]), 1e-12)
+        rows.append({
+            "country_or_area": key[0],
+            "category": key[1],
+            "ar_difference": np.abs(fit["ar"][row] - sarimax_ar).max() if order[0] > 0 else 0.0,
+            "forecast_difference": np.abs(mean[row] - sarimax_mean).max() / scale,
+        })
+    return pd.DataFrame(rows)